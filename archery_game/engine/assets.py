@@ -0,0 +1,160 @@
+from collections import OrderedDict
+from typing import Tuple
+
+import pygame
+
+
+class TextureCache:
+    r"""
+        Images loaded from disk, shared by every sprite that draws them.
+        Each (path, size) pair is loaded or scaled once and kept until it
+        is the least recently used of more than `limit` surfaces
+    """
+
+    def __init__(self, limit : int = 256):
+        assert limit > 0, 'TextureCache: limit must be positive'
+
+        self.limit = limit
+        self.surfaces = OrderedDict()
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def __contains__(self, key : Tuple[str, tuple]):
+        return key in self.surfaces
+
+    def clear(self):
+        self.surfaces.clear()
+
+    def _store(self, key : tuple, surface : pygame.Surface) -> pygame.Surface:
+        self.surfaces[key] = surface
+        while len(self.surfaces) > self.limit:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def get(self, path : str, size : Tuple[int, int] = None) -> pygame.Surface:
+        r"""
+            The image at `path`, scaled to `size` if one is given. The
+            surfaces are shared, so they should not be drawn on
+        """
+        key = (path, None if size is None else tuple(size))
+
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+
+        if size is None:
+            surface = pygame.image.load(path).convert_alpha()
+        else:
+            surface = pygame.transform.scale(self.get(path), key[1])
+
+        return self._store(key, surface)
+
+class RotationCache:
+    r"""
+        Rotated copies of the textures in a TextureCache. Angles are
+        snapped to multiples of `step` degrees, so sprites that turn a
+        little every frame keep reusing the same few copies. Keeps up to
+        `limit` copies, dropping the least recently used
+    """
+
+    def __init__(self, textures : TextureCache, step : float = 1.0, limit : int = 2048):
+        assert step > 0, 'RotationCache: step must be positive'
+        assert limit > 0, 'RotationCache: limit must be positive'
+
+        self.textures = textures
+        self.step = step
+        self.limit = limit
+        self.surfaces = OrderedDict()
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def clear(self):
+        self.surfaces.clear()
+
+    def snap(self, angle : float) -> float:
+        r"""
+            The angle in degrees, in [0, 360), that a rotation by `angle`
+            degrees is drawn with
+        """
+        return (round(angle / self.step) * self.step) % 360
+
+    def get(self, path : str, size : Tuple[int, int], angle : float) -> pygame.Surface:
+        r"""
+            The image at `path`, scaled to `size`, rotated counterclockwise
+            by about `angle` degrees. It is meant to be drawn centred on
+            the pivot, as pygame grows rotated surfaces around their centre
+        """
+        angle = self.snap(angle)
+        key = (path, None if size is None else tuple(size), angle)
+
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+
+        surface = pygame.transform.rotate(self.textures.get(path, size), angle)
+
+        self.surfaces[key] = surface
+        while len(self.surfaces) > self.limit:
+            self.surfaces.popitem(last=False)
+        return surface
+
+class TextCache:
+    r"""
+        Fonts and rendered strings. Fonts are opened once per (face,
+        size) and each string is rendered once per font, colour and
+        antialiasing, keeping up to `limit` rendered surfaces and
+        dropping the least recently used. The face defaults to
+        pygame's default font
+    """
+
+    def __init__(self, limit : int = 256):
+        assert limit > 0, 'TextCache: limit must be positive'
+
+        self.limit = limit
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def clear(self):
+        self.fonts.clear()
+        self.surfaces.clear()
+
+    def font(self, size : int, face : str = None) -> pygame.font.Font:
+        key = (face, size)
+
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = pygame.font.Font(
+                pygame.font.get_default_font() if face is None else face, size
+            )
+        return font
+
+    def render(self, text : str, size : int, colour, face : str = None,
+               antialias : bool = True) -> pygame.Surface:
+        r"""
+            The string drawn in the given font and colour. The surfaces
+            are shared, so they should not be drawn on
+        """
+        key = (text, face, size, colour if isinstance(colour, str) else tuple(colour), antialias)
+
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+
+        surface = self.font(size, face).render(text, antialias, colour)
+
+        self.surfaces[key] = surface
+        while len(self.surfaces) > self.limit:
+            self.surfaces.popitem(last=False)
+        return surface
+
+textures = TextureCache()
+rotations = RotationCache(textures)
+texts = TextCache()
@@ -0,0 +1,91 @@
+from itertools import chain
+from typing import Hashable, Iterator, List, Set, Tuple
+
+import numpy as np
+
+
+class SpatialHash:
+    r"""
+        Uniform grid broadphase. Every axis-aligned box is bucketed into
+        the cells it covers, and only boxes that share a cell are handed
+        on to the narrowphase as candidate pairs
+    """
+
+    def __init__(self, cell_size : float = 64.0):
+        assert cell_size > 0, 'SpatialHash: cell_size must be positive'
+
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def __len__(self):
+        return len(self.cells)
+
+    def clear(self):
+        self.cells = {}
+
+    def span(self, x1 : float, x2 : float, y1 : float, y2 : float) -> Tuple[int, int, int, int]:
+        r"""
+            The inclusive range of cells covered by a box, using the same
+            (left, right, top, bottom) convention as CollisionComponent
+        """
+        s = self.cell_size
+        return int(x1 // s), int(x2 // s), int(y2 // s), int(y1 // s)
+
+    def _cells(self, cx1 : int, cx2 : int, cy1 : int, cy2 : int) -> Iterator[Tuple[int, int]]:
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                yield (cx, cy)
+
+    def insert_many(self, bounds : np.ndarray, items : List[Hashable] = None):
+        r"""
+            Insert a (n, 4) array of x1, x2, y1, y2 rows. Each row is
+            stored under the matching entry of `items`, or under its row
+            number when no items are given
+        """
+        spans = np.floor_divide(bounds, self.cell_size).astype(np.int64)
+        cells = self.cells
+
+        if items is None:
+            items = range(len(spans))
+
+        for i, (cx1, cx2, cy1, cy2) in zip(items, spans.tolist()):
+            # y1 is the top of the box, so it gives the highest cell
+            for key in self._cells(cx1, cx2, cy2, cy1):
+                bucket = cells.get(key)
+                if bucket is None:
+                    cells[key] = [i]
+                else:
+                    bucket.append(i)
+
+    def query(self, x1 : float, x2 : float, y1 : float, y2 : float) -> Set[Hashable]:
+        r"""
+            Every item sharing a cell with the given box
+        """
+        found = set()
+        cells = self.cells
+        for key in self._cells(*self.span(x1, x2, y1, y2)):
+            bucket = cells.get(key)
+            if bucket is not None:
+                found.update(bucket)
+        return found
+
+    def pair_array(self) -> Tuple[np.ndarray, np.ndarray]:
+        r"""
+            Every pair of integer items that share a cell, as two arrays
+            built without a tuple per pair. When items are inserted in
+            increasing order, the smaller item of a pair comes first.
+            A pair that shares several cells comes back once for each
+        """
+        buckets = [bucket for bucket in self.cells.values() if len(bucket) > 1]
+        if not buckets:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+
+        sizes = np.array([len(bucket) for bucket in buckets])
+        items = np.fromiter(chain.from_iterable(buckets), dtype=np.int64, count=int(sizes.sum()))
+
+        # Each item is paired with the ones after it in its bucket
+        after = np.repeat(np.cumsum(sizes), sizes) - np.arange(len(items)) - 1
+        left = np.repeat(np.arange(len(items)), after)
+        right = left + 1 + np.arange(len(left)) - np.repeat(np.cumsum(after) - after, after)
+        return items[left], items[right]
@@ -1,10 +1,13 @@
 from dataclasses import dataclass as component
-from enum import Enum
+from enum import Enum, IntFlag
+from math import nan
 from typing import Callable
 
-from archery_game.engine.ecs import Entity
+from archery_game.engine.ecs import Entity, events
+from archery_game.engine.storage import columnar
 
 
+@columnar('x', 'y')
 @component
 class PositionComponent:
     namespace = 'position'
@@ -13,6 +16,7 @@ class PositionComponent:
     x : float = 0.0
     y : float = 0.0
 
+@columnar('vx', 'vy')
 @component
 class VelocityComponent:
     namespace = 'velocity'
@@ -21,6 +25,7 @@ class VelocityComponent:
     vx : float = 0.0
     vy : float = 0.0
 
+@columnar('ax', 'ay')
 @component
 class AccelerationComponent:
     namespace = 'accel'
@@ -61,11 +66,25 @@ class CollisionType(Enum):
     RIGID = 2
     STICK = 3
 
+class CollisionLayer(IntFlag):
+    NONE = 0
+    DEFAULT = 1
+    SCENERY = 2
+    PLAYER = 4
+    PROJECTILE = 8
+    TARGET = 16
+    ENEMY = 32
+    ALL = DEFAULT | SCENERY | PLAYER | PROJECTILE | TARGET | ENEMY
+
+@columnar('x1', 'x2', 'y1', 'y2', 'ox1', 'ox2', 'oy1', 'oy2')
 @component
 class CollisionComponent:
     namespace = 'collide'
 
-    # Axis-aligned bounding box
+    # Axis-aligned bounding box, given in world coordinates. On an entity
+    # with a position the box is kept as offsets from it (ox1, ox2, oy1,
+    # oy2) and CollisionSystem derives the world box from those, so
+    # moving the position is enough to move the box
     x1 : float # left
     x2 : float # right
     y1 : float # top
@@ -73,12 +92,38 @@ class CollisionComponent:
 
     ctype : CollisionType = CollisionType.SLIDE
 
+    # Two bodies are only tested against each other if each one's layer
+    # is in the other's mask. Like ctype, these are read when the
+    # component is attached and should not be edited afterwards
+    layer : int = CollisionLayer.DEFAULT
+    mask : int = CollisionLayer.ALL
+
+    # Sweep the box along its path each step so fast movers can't
+    # tunnel through thin bodies. Needs dt to be passed to CollisionSystem
+    continuous : bool = False
+
     def __post_init__(self):
         assert self.x1 < self.x2, 'CollisionComponent: x1 must be less than x2'
         assert self.y1 > self.y2, 'CollisionComponent: y1 must be greater than y2'
 
         self.height = self.y1 - self.y2
         self.width = self.x2 - self.x1
+
+        # Not anchored to a position yet
+        self.ox1 = self.ox2 = self.oy1 = self.oy2 = nan
+
+    def attached(self, entity : Entity):
+        if entity.has(PositionComponent):
+            self.anchor(entity.position.x, entity.position.y)
+
+    def anchor(self, x : float, y : float):
+        r"""
+            Keep the current box as offsets from the point (x, y)
+        """
+        self.ox1 = self.x1 - x
+        self.ox2 = self.x2 - x
+        self.oy1 = self.y1 - y
+        self.oy2 = self.y2 - y
     
 @component
 class CustomMotionComponent:
@@ -87,6 +132,28 @@ class CustomMotionComponent:
     expression_x : Callable[[float], float] = None
     expression_y : Callable[[float], float] = None
 
+    # Added to the time the expressions are evaluated at
+    phase : float = 0.0
+
+    # The expressions also accept an array of times, so every entity
+    # sharing one can be moved with a single call
+    vectorized : bool = False
+
+    # Periodic paths can be sampled at `samples` points over one period
+    # and interpolated from then on instead of being evaluated
+    period : float = None
+    samples : int = 256
+
+    # Where the path is measured from. Defaults to the entity's
+    # position when CustomMotionSystem first sees it
+    ox : float = None
+    oy : float = None
+
+    def __post_init__(self):
+        assert self.period is None or self.period > 0, \
+            'CustomMotionComponent: period must be positive'
+        assert self.samples > 1, 'CustomMotionComponent: samples must be at least 2'
+
 @component
 class RenderComponent:
     namespace = 'render'
@@ -101,6 +168,22 @@ class RenderComponent:
     def __lt__(self, other):
         return self.priority < other.priority
 
+def _priority() -> property:
+    def fget(self):
+        return self._priority
+
+    def fset(self, value):
+        old = self.__dict__.get('_priority')
+        self._priority = value
+
+        # Lets render lists move the entity to its new place
+        if old is not None and old != value:
+            events.fire('render_priority', render=self, old=old)
+
+    return property(fget, fset)
+
+RenderComponent.priority = _priority()
+
 @component
 class ControlComponent:
     namespace = 'control'
@@ -113,10 +196,25 @@ class PairedComponent:
 
     pair_id : int
 
+    # Offset from the paired entity's position, filled in by the
+    # PairedSystem the first time it sees the pairing
+    x : float = None
+    y : float = None
+
     def __post_init__(self):
+        assert Entity.alive(self.pair_id), \
+            f"PairedComponent: Paired entity {self.pair_id} doesn't exist"
         assert Entity.get(self.pair_id).has(PositionComponent), \
             "PairedComponent: Paired entity must have a position component"
 
+@component
+class SleepComponent:
+    namespace = 'sleep'
+
+    # Pinned bodies are held in place by something else, such as a
+    # pairing, so they also leave collision instead of waiting for a touch
+    pinned : bool = False
+
 @component
 class ShooterComponent:
     namespace = 'shooter'
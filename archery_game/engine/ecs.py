@@ -1,5 +1,7 @@
-import uuid
-from typing import List
+import inspect
+import weakref
+from collections import deque
+from typing import Callable, List
 from dataclasses import dataclass as component
 from abc import ABC, abstractmethod
 
@@ -7,63 +9,190 @@ from abc import ABC, abstractmethod
 class Component:
     pass
 
+class IdAllocator:
+    r"""
+        Hands out compact integer entity ids. The low INDEX_BITS bits hold
+        a dense slot index that can address arrays directly, and the bits
+        above count how many times that slot has been reused, so an id
+        kept around after its entity is gone can be told apart cheaply
+    """
+    INDEX_BITS = 24
+    INDEX_MASK = (1 << INDEX_BITS) - 1
+
+    def __init__(self):
+        self.generations = []  # slot -> current generation
+        self.free = deque()    # released slots, reused oldest first
+
+    def allocate(self) -> int:
+        if self.free:
+            slot = self.free.popleft()
+        else:
+            slot = len(self.generations)
+            assert slot <= self.INDEX_MASK, 'IdAllocator: out of entity slots'
+            self.generations.append(0)
+
+        return (self.generations[slot] << self.INDEX_BITS) | slot
+
+    def release(self, id: int):
+        slot = id & self.INDEX_MASK
+        assert self.is_alive(id), 'IdAllocator: id was already released'
+
+        self.generations[slot] += 1
+        self.free.append(slot)
+
+    def is_alive(self, id: int) -> bool:
+        slot = id & self.INDEX_MASK
+        return slot < len(self.generations) \
+            and self.generations[slot] == id >> self.INDEX_BITS
+
+    @classmethod
+    def index(cls, id: int) -> int:
+        return id & cls.INDEX_MASK
+
+    @classmethod
+    def generation(cls, id: int) -> int:
+        return id >> cls.INDEX_BITS
+
+class ComponentPool:
+    r"""
+        Free lists of components left behind by despawned entities.
+        acquire() re-initialises a pooled component instead of allocating
+        a new one, so spawning in bursts doesn't churn the heap
+    """
+    pools = {}
+    # The most components of one type that are kept around
+    limit = 1024
+
+    @classmethod
+    def release(cls, component: Component):
+        free = cls.pools.setdefault(type(component), [])
+        if len(free) < cls.limit:
+            free.append(component)
+
+    @classmethod
+    def acquire(cls, component_type: type, *args, **kwargs) -> Component:
+        free = cls.pools.get(component_type)
+        if not free:
+            return component_type(*args, **kwargs)
+
+        # Drop anything systems cached on the old component first
+        c = free.pop()
+        c.__dict__.clear()
+        c.__init__(*args, **kwargs)
+        return c
+
 class Entity:
     # These are shared among all entity classes
     entity_index = {}
     component_index = {}
+    allocator = IdAllocator()
 
     def __init__(self, components : List[Component] = []):
-        self.id = uuid.uuid4().int
+        self.id = self.allocator.allocate()
+        # The slot index, used to address component stores
+        self.index = self.id & IdAllocator.INDEX_MASK
         self.entity_index[self.id] = self
 
-        self.components = []
+        # Component type -> component, so lookups don't scan
+        self.component_map = {}
+        # The names of the attached component types, used by queries
+        self.signature = set()
+
         for c in components:
             self.attach(c)
 
+    @property
+    def components(self) -> List[Component]:
+        return list(self.component_map.values())
+
     def attach(self, component):
-        self.components.append(component)
+        # An entity holds one component of each type
+        if type(component) in self.component_map:
+            self.dettach(type(component))
+
+        self.component_map[type(component)] = component
 
         if hasattr(component, 'namespace'):
             self.__dict__[component.namespace] = component
 
+        # Columnar components keep their data in a shared store
+        if hasattr(component, 'store'):
+            component.store.add(self.index, component)
+
+        # Components can finish setting up once they know their entity
+        if hasattr(component, 'attached'):
+            component.attached(self)
+
+        # Dicts are used as ordered sets so entities can leave in O(1)
         name = component.__class__.__name__
         if name not in self.component_index:
-            self.component_index[name] = []
+            self.component_index[name] = {}
 
-        self.component_index[name].append(self)
+        self.component_index[name][self] = None
+        self.signature.add(name)
+        Query.on_change(self, name)
 
     def dettach(self, component):
-        if self.has(component):
-            self.component_index[component.__name__].remove(self)
+        if component in self.component_map:
+            del self.component_index[component.__name__][self]
             del self.__dict__[component.namespace]
 
-            idx = -1
-            for i, c in enumerate(self.components):
-                if isinstance(c, component):
-                    idx = i
+            if hasattr(component, 'store'):
+                component.store.remove(self.index)
 
-            self.components.pop(idx)
+            del self.component_map[component]
+            self.signature.discard(component.__name__)
+            Query.on_change(self, component.__name__)
 
-    def getC(self, component: Component) -> Component:
+    def despawn(self, recycle: bool = True):
+        r"""
+            Remove the entity from every index and free its id. With
+            recycle=True its components go back to the ComponentPool.
+            Any id kept around afterwards is stale and Entity.get returns
+            None for it
+        """
         for c in self.components:
-            if isinstance(c, component):
-                return c
-        return None
+            self.dettach(type(c))
+            if recycle:
+                ComponentPool.release(c)
+
+        del self.entity_index[self.id]
+        self.allocator.release(self.id)
+
+    def getC(self, component: Component, inherit: bool = False) -> Component:
+        r"""
+            The attached component of exactly this type. With inherit=True
+            subclasses match too, at the cost of a scan
+        """
+        if inherit:
+            for c in self.component_map.values():
+                if isinstance(c, component):
+                    return c
+            return None
+
+        return self.component_map.get(component)
 
     @classmethod
     def filter(cls, component: Component) -> List['Entity']:
         entities = cls.component_index.get(component.__name__)
-        return entities if entities is not None else []
+        return list(entities) if entities is not None else []
 
     @classmethod
     def get(cls, id) -> 'Entity':
+        r"""
+            The entity with this id, or None if the id is stale
+        """
         return cls.entity_index.get(id, None)
 
-    def has(self, component: Component) -> bool:
-        for c in self.components:
-            if isinstance(c, component):
-                return True
-        return False
+    @classmethod
+    def alive(cls, id) -> bool:
+        return cls.allocator.is_alive(id) and id in cls.entity_index
+
+    def has(self, component: Component, inherit: bool = False) -> bool:
+        if inherit:
+            return self.getC(component, inherit=True) is not None
+
+        return component in self.component_map
 
     def __hash__(self):
         return self.id
@@ -71,46 +200,330 @@ class Entity:
     def __eq__(self, other):
         return self.id == other.id
 
+class Query:
+    r"""
+        A cached list of the entities that have all of the given components
+        and none of the excluded ones. Membership is kept up to date by
+        Entity.attach and Entity.dettach, so reading it every frame costs
+        nothing.
+
+        An optional `where` predicate narrows the query further. It is
+        re-evaluated whenever the entity gains or loses any component, so
+        it should only look at the entity's components and at fields that
+        are fixed once the component is built.
+
+        Objects passed to `watch` have their `added` and `removed` methods
+        called as entities join and leave
+    """
+    # Queries are shared between systems that require the same components
+    registry = {}
+    # The queries that need to hear about each component name
+    by_component = {}
+    # Queries with a predicate hear about every component
+    predicated = []
+
+    def __init__(self, components: List[Component], exclude: List[Component] = [],
+                 where: Callable[['Entity'], bool] = None):
+        self.names = frozenset(c.__name__ for c in components)
+        self.excluded = frozenset(c.__name__ for c in exclude)
+        self.where = where
+
+        # A dict is used as an insertion-ordered set
+        self.members = {}
+        self._entities = None
+        # Held weakly like Observer.watchers
+        self.watchers = weakref.WeakSet()
+
+        if where is not None:
+            self.predicated.append(self)
+        else:
+            for name in self.names | self.excluded:
+                self.by_component.setdefault(name, []).append(self)
+
+        # Seed with the current entities, starting from the rarest component
+        if self.names:
+            rarest = min(self.names, key=lambda n: len(Entity.component_index.get(n, [])))
+            for e in Entity.component_index.get(rarest, []):
+                if self.matches(e):
+                    self.add(e)
+
+    @classmethod
+    def of(cls, components: List[Component], exclude: List[Component] = [],
+           where: Callable[['Entity'], bool] = None) -> 'Query':
+        key = (
+            frozenset(c.__name__ for c in components),
+            frozenset(c.__name__ for c in exclude),
+            where
+        )
+        if key not in cls.registry:
+            cls.registry[key] = cls(components, exclude, where)
+        return cls.registry[key]
+
+    def matches(self, entity: 'Entity') -> bool:
+        names = entity.signature
+        if not self.names <= names or not self.excluded.isdisjoint(names):
+            return False
+        return self.where is None or bool(self.where(entity))
+
+    def refresh(self, entity: 'Entity'):
+        if self.matches(entity):
+            self.add(entity)
+        else:
+            self.discard(entity)
+
+    def watch(self, watcher):
+        r"""
+            Start telling `watcher` about entities that join and leave.
+            The current members are passed to its `added` method first
+        """
+        self.watchers.add(watcher)
+        for e in self.members:
+            watcher.added(e)
+
+    def add(self, entity: 'Entity'):
+        if entity not in self.members:
+            self.members[entity] = None
+            self._entities = None
+            if self.watchers:
+                for w in list(self.watchers):
+                    w.added(entity)
+
+    def discard(self, entity: 'Entity'):
+        if entity in self.members:
+            del self.members[entity]
+            self._entities = None
+            if self.watchers:
+                for w in list(self.watchers):
+                    w.removed(entity)
+
+    @property
+    def entities(self) -> List['Entity']:
+        # Rebuilt only after the membership changed. A new list is made
+        # instead of editing the old one so that systems iterating over
+        # the previous result are not disturbed by attach/dettach calls
+        if self._entities is None:
+            self._entities = list(self.members)
+        return self._entities
+
+    @classmethod
+    def on_change(cls, entity: 'Entity', name: str):
+        r"""
+            Called after `entity` gained or lost the component called `name`
+        """
+        for q in cls.by_component.get(name, []):
+            q.refresh(entity)
+        for q in cls.predicated:
+            q.refresh(entity)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        return iter(self.entities)
+
+class CommandBuffer:
+    r"""
+        Queues structural changes (spawn, attach, dettach and despawn) so
+        they are applied together at a sync point rather than while a
+        system is iterating over a query. Commands run in the order they
+        were queued
+    """
+
+    def __init__(self):
+        self.queue = []
+
+    def __len__(self):
+        return len(self.queue)
+
+    def spawn(self, components: List[Component] = []) -> 'Entity':
+        r"""
+            The entity is created straight away so it can be referred to,
+            but it has no components, and so shows up in no query, until
+            the next flush
+        """
+        entity = Entity()
+        for c in components:
+            self.queue.append((self._attach, entity, c, True))
+        return entity
+
+    def attach(self, entity: 'Entity', component: Component, replace: bool = False):
+        r"""
+            Unless replace is set, the component is dropped if the entity
+            already has one of its type by the time the buffer is flushed
+        """
+        self.queue.append((self._attach, entity, component, replace))
+
+    def dettach(self, entity: 'Entity', component: type):
+        self.queue.append((self._dettach, entity, component))
+
+    def despawn(self, entity: 'Entity', recycle: bool = True):
+        self.queue.append((self._despawn, entity, recycle))
+
+    @staticmethod
+    def _attach(entity: 'Entity', component: Component, replace: bool):
+        if replace or not entity.has(type(component)):
+            entity.attach(component)
+
+    @staticmethod
+    def _dettach(entity: 'Entity', component: type):
+        entity.dettach(component)
+
+    @staticmethod
+    def _despawn(entity: 'Entity', recycle: bool):
+        entity.despawn(recycle)
+
+    def flush(self):
+        while self.queue:
+            queue, self.queue = self.queue, []
+            for (command, entity, *args) in queue:
+                # Skip commands for entities despawned in the meantime
+                if Entity.alive(entity.id):
+                    command(entity, *args)
+
+# The shared command buffer, flushed at every sync point
+commands = CommandBuffer()
+
+def sync():
+    r"""
+        Apply queued structural changes and deliver queued events. Called
+        by System.get before a system starts iterating, and can be called
+        by game loops too
+    """
+    if commands.queue:
+        commands.flush()
+    if events.pending:
+        events.dispatch()
+
 class System(ABC):
 
     def __init__(self):
         self.requires = []
+        self.excludes = []
+        self.query = None
 
     def subscribe(self, component: Component):
         self.requires.append(component)
+        # The query is built lazily on the first get() so that systems
+        # subscribing to several components only register one query
+        self.query = None
+
+    def exclude(self, component: Component):
+        r"""
+            Skip entities that have this component
+        """
+        self.excludes.append(component)
+        self.query = None
 
     def get(self) -> List['Entity']:
-        res = []
-        
-        # need to return components that have all of these 
-        for component in self.requires:
-            res += [ set(Entity.filter(component)) ]
+        sync()
+
+        if self.query is None:
+            self.query = Query.of(self.requires, self.excludes)
 
-        return list(set.intersection(*res))
+        return self.query.entities
 
     @abstractmethod
     def update(self, **kwargs):
         pass
 
+class EventBus:
+    r"""
+        Delivers events to the callbacks subscribed to their name.
+
+        fire() calls the subscribers straight away, while post() queues the
+        event until the next dispatch(), which happens at every sync point.
+        Subscribers registered with batch=True get every queued event of
+        that name in one call, as a list of keyword dicts.
+
+        Callbacks are held through weak references, so subscribing doesn't
+        keep an observer alive; whoever subscribes must hold on to the
+        callback, as Observer does. Builtins such as print or a list's
+        append can't be weakly referenced and are held strongly instead
+    """
+
+    def __init__(self):
+        self.subscribers = {}  # name -> [(weak callback, batch)]
+        self.pending = {}      # name -> [kwargs]
+
+    @staticmethod
+    def _ref(callback: Callable) -> weakref.ref:
+        if inspect.ismethod(callback):
+            return weakref.WeakMethod(callback)
+        # Bound builtins like list.append are made afresh on every lookup
+        # and would die straight away, and plain builtins can't be weakly
+        # referenced at all
+        if not inspect.isbuiltin(callback):
+            try:
+                return weakref.ref(callback)
+            except TypeError:
+                pass
+        return lambda: callback
+
+    def subscribe(self, name: str, callback: Callable, batch: bool = False):
+        self.subscribers.setdefault(name, []).append((self._ref(callback), batch))
+
+    def has_subscribers(self, name: str) -> bool:
+        return bool(self.subscribers.get(name))
+
+    def _live(self, name: str) -> list:
+        subscribers = self.subscribers.get(name)
+        if not subscribers:
+            return []
+
+        live = [(ref(), batch) for (ref, batch) in subscribers]
+        if any(c is None for (c, _) in live):
+            self.subscribers[name] = [s for s, (c, _) in zip(subscribers, live) if c is not None]
+            live = [(c, batch) for (c, batch) in live if c is not None]
+        return live
+
+    def fire(self, name: str, **kwargs):
+        for (c, batch) in self._live(name):
+            if batch:
+                c([kwargs])
+            else:
+                c(**kwargs)
+
+    def post(self, name: str, **kwargs):
+        # Nobody is listening, so don't bother keeping it
+        if self.has_subscribers(name):
+            self.pending.setdefault(name, []).append(kwargs)
+
+    def dispatch(self):
+        while self.pending:
+            pending, self.pending = self.pending, {}
+            for name, queued in pending.items():
+                for (c, batch) in self._live(name):
+                    if batch:
+                        c(queued)
+                    else:
+                        for kwargs in queued:
+                            c(**kwargs)
+
+# The shared event bus
+events = EventBus()
+
 class Observer(ABC):
-    watchers = []
+    # Held weakly so observers that are no longer used can be collected
+    watchers = weakref.WeakSet()
 
     def __init__(self):
-        self.watchers.append(self)
+        self.watchers.add(self)
         self.callbacks = {}
 
-    def watch(self, event_name, callback):
+    def watch(self, event_name, callback, batch : bool = False):
         if not event_name in self.callbacks:
             self.callbacks[event_name] = []
 
+        # The observer keeps the callback alive, the bus only refers to it
         self.callbacks[event_name] += [ callback ]
+        events.subscribe(event_name, callback, batch)
 
 class Event(ABC):
     def __init__(self, name):
         self.name = name
 
     def fire(self, **kwargs):
-        for observer in Observer.watchers:
-            if self.name in observer.callbacks:
-                for c in observer.callbacks[self.name]:
-                    c(**kwargs)
\ No newline at end of file
+        events.fire(self.name, **kwargs)
+
+    def post(self, **kwargs):
+        events.post(self.name, **kwargs)
@@ -1,13 +1,19 @@
-import operator
-from math import cos, degrees, sin
-from copy import copy
+from bisect import insort
+from functools import lru_cache
+from itertools import chain
+from math import cos, degrees, hypot, isnan, sin
+from typing import List, Tuple
 
+import numpy as np
 import pygame
+from archery_game.engine.assets import rotations, textures
+from archery_game.engine.broadphase import SpatialHash
 from archery_game.engine.components import (CollisionComponent,
                                             PositionComponent, RenderComponent,
-                                            RotateComponent)
-from archery_game.engine.ecs import System
-from archery_game.engine.systems import cartesian_to_screen
+                                            RotateComponent, ShooterComponent)
+from archery_game.engine.ecs import Entity, Query, System, events, sync
+from archery_game.engine.storage import RowCache
+from archery_game.engine.systems import MOVERS
 
 WHITE = (255,255,255)
 BLUE = (0,0,255)
@@ -22,73 +28,482 @@ def gradientRect(target_rect, left_colour, right_colour):
     colour_rect = pygame.transform.smoothscale( colour_rect, ( target_rect.width, target_rect.height ) )  # stretch!
     return colour_rect
 
+# Radius of the debug markers
+MARKER = 5
+
+# Size of the grid cells still sprites are culled with, in world units,
+# and how many still sprites there must be before the grid is used
+CULL_CELL = 256.0
+CULL_GRID = 1024
+
+@lru_cache(maxsize=None)
+def marker(colour : tuple) -> pygame.Surface:
+    r"""
+        A filled debug circle, drawn once per colour
+    """
+    surface = pygame.Surface((2 * MARKER, 2 * MARKER), pygame.SRCALPHA)
+    pygame.draw.circle(surface, colour, (MARKER, MARKER), MARKER)
+    return surface
+
+# Anything that can move an entity keeps it out of the static layer
+MOVING = MOVERS + [ShooterComponent]
+
+def is_still(e : Entity) -> bool:
+    return not any(e.has(c) for c in MOVING)
+
+class Camera:
+    r"""
+        Maps world coordinates, with y pointing up, onto a `width` by
+        `height` screen. The view is centred on the world point (x, y)
+        and `zoom` is the number of pixels per world unit. The default
+        camera shows the world from (0, 0) to (width, height)
+    """
+
+    def __init__(self, width : int, height : int, x : float = None, y : float = None, zoom : float = 1.0):
+        assert zoom > 0, 'Camera: zoom must be positive'
+
+        self.width = width
+        self.height = height
+        self.x = width / 2 if x is None else x
+        self.y = height / 2 if y is None else y
+        self.zoom = zoom
+
+    @property
+    def state(self) -> tuple:
+        return (self.x, self.y, self.zoom, self.width, self.height)
+
+    def pan(self, dx : float, dy : float):
+        self.x += dx
+        self.y += dy
+
+    def zoom_by(self, factor : float):
+        assert factor > 0, 'Camera: zoom factor must be positive'
+        self.zoom *= factor
+
+    def to_screen(self, x : float, y : float) -> Tuple[float, float]:
+        return (x - self.x) * self.zoom + self.width / 2, \
+            self.height / 2 - (y - self.y) * self.zoom
+
+    def to_world(self, sx : float, sy : float) -> Tuple[float, float]:
+        return (sx - self.width / 2) / self.zoom + self.x, \
+            (self.height / 2 - sy) / self.zoom + self.y
+
+    def view(self, margin : float = 0) -> Tuple[float, float, float, float]:
+        r"""
+            The visible part of the world as (x1, x2, y1, y2), grown by
+            `margin` pixels on every side
+        """
+        hw = (self.width / 2 + margin) / self.zoom
+        hh = (self.height / 2 + margin) / self.zoom
+        return self.x - hw, self.x + hw, self.y + hh, self.y - hh
+
+def extent(e : Entity) -> Tuple[float, float, float, float]:
+    r"""
+        What an entity draws, as (x1, x2, y1, y2) offsets from its
+        position in world units. Rotated sprites get a box that holds
+        them at any angle
+    """
+    x1 = x2 = y1 = y2 = 0.0
+
+    if e.render.path is not None:
+        w, h = textures.get(e.render.path, e.render.size).get_size()
+        cx, cy = e.render.center if e.render.center is not None else (0, 0)
+
+        if e.has(RotateComponent) and e.render.center is not None:
+            r = hypot(w, h) + hypot(cx, 2 * cy)
+            x1, x2, y1, y2 = -r, r, r, -r
+        else:
+            x1, x2, y1, y2 = -cx, w - cx, cy, cy - h
+
+    if e.has(CollisionComponent) and e.render.debug and not isnan(e.collide.ox1):
+        x1 = min(x1, e.collide.ox1)
+        x2 = max(x2, e.collide.ox2)
+        y1 = max(y1, e.collide.oy1)
+        y2 = min(y2, e.collide.oy2)
+
+    return x1, x2, y1, y2
+
+def sprites(entities : List[Entity], indices : List[int]) -> tuple:
+    r"""
+        The entities at `indices`, the indices as an array and the
+        entities' extents as a (n, 4) array
+    """
+    chosen = [entities[i] for i in indices]
+    extents = np.array([extent(e) for e in chosen], dtype=float).reshape(-1, 4)
+    return chosen, np.array(indices, dtype=np.intp), extents
+
+def in_view(boxes : np.ndarray, view : Tuple[float, float, float, float]) -> np.ndarray:
+    r"""
+        Which of the (n, 4) world boxes intersect the view
+    """
+    x1, x2, y1, y2 = view
+    return (boxes[:, 0] < x2) & (boxes[:, 1] > x1) & (boxes[:, 2] > y2) & (boxes[:, 3] < y1)
+
+class RenderList:
+    r"""
+        The entities of a query in draw order, kept in one bucket per
+        priority. The query tells the list about each entity that joins or
+        leaves, and a RenderComponent announces its own priority changes,
+        so only that entity is moved and the order is ready without
+        sorting every frame
+    """
+
+    def __init__(self, query : Query):
+        self.query = query
+
+        self.buckets = {}     # priority -> dict used as an ordered set
+        self.priorities = []  # bucket keys, lowest first
+        self.members = {}     # entity -> (priority, id of its RenderComponent)
+        self.renders = {}     # id of RenderComponent -> entity
+
+        self._order = []
+        self._stale = False
+
+        events.subscribe('render_priority', self._reprioritize)
+        query.watch(self)
+
+    def __len__(self):
+        return len(self.members)
+
+    def _add(self, e : Entity, priority : int, key : int):
+        bucket = self.buckets.get(priority)
+        if bucket is None:
+            bucket = self.buckets[priority] = {}
+            insort(self.priorities, priority)
+
+        bucket[e] = None
+        self.members[e] = (priority, key)
+        self._stale = True
+
+    def _remove(self, e : Entity) -> int:
+        priority, key = self.members.pop(e)
+        bucket = self.buckets[priority]
+        del bucket[e]
+
+        if not bucket:
+            del self.buckets[priority]
+            self.priorities.remove(priority)
+
+        self._stale = True
+        return key
+
+    def added(self, e : Entity):
+        self._add(e, e.render.priority, id(e.render))
+        self.renders[id(e.render)] = e
+
+    def removed(self, e : Entity):
+        del self.renders[self._remove(e)]
+
+    def _reprioritize(self, render : RenderComponent, old : int):
+        e = self.renders.get(id(render))
+        if e is None:
+            return
+
+        self._add(e, render.priority, self._remove(e))
+
+    @property
+    def entities(self) -> List[Entity]:
+        # Handed out as a new list whenever the order changed, since
+        # callers cache work against the identity of the one they got
+        if self._stale:
+            self._order = list(chain.from_iterable(self.buckets[p] for p in self.priorities))
+            self._stale = False
+
+        return self._order
+
 class RenderSystem(System):
-    def __init__(self):
+    r"""
+        Draws entities in order of priority.
+
+        Given a background surface the renderer also keeps a static layer:
+        the background with every still entity at or below
+        `static_priority` drawn onto it. Since everything else is drawn
+        over the layer, the cutoff is lowered to the lowest priority of
+        anything that isn't still. The layer is composited once and
+        rebuilt only when those entities change or `invalidate` is called.
+        Each frame only the regions drawn over during the previous frame
+        are restored from it, and `present` sends just the changed regions
+        to the display. Anything else drawn on the screen should be passed
+        to `mark_dirty` so it is cleaned up the same way.
+
+        Entities are drawn through a Camera, and those whose sprites lie
+        outside its view are skipped
+    """
+
+    def __init__(self, background : pygame.Surface = None, static_priority : int = 0,
+                 camera : Camera = None):
         super().__init__()
 
         self.subscribe(RenderComponent)
 
+        self.background = background
+        self.static_priority = static_priority
+
+        # Made to fit the screen on the first update if not given
+        self.camera = camera
+
+        # Regions of the screen that changed since the last present
+        self.dirty = []
+
+        self.order = RenderList(Query.of([RenderComponent]))
+
+        self.layer = None
+        self.still = Query.of([RenderComponent, PositionComponent], where=is_still)
+
+        self._static = (None, None, [], set())  # still entities, draw order -> (static list, static set)
+        self._baked = None                # static positions and camera the layer was built from
+        self._drawn = []                  # regions drawn over since the last restore
+        self._rows = RowCache(PositionComponent.store)
+
+        self._extents = (None, None, None, None, None)  # draw order, still entities -> sprite bounds
+        self._grid = (None, None)                       # still sprite positions -> SpatialHash of their boxes
+        self._fixed_rows = RowCache(PositionComponent.store)
+        self._moving_rows = RowCache(PositionComponent.store)
+
+    def invalidate(self):
+        r"""
+            Rebuild the static layer and the sprite bounds used for
+            culling on the next update
+        """
+        self._baked = None
+        self._extents = (None, None, None, None, None)
+        self._grid = (None, None)
+
+    def mark_dirty(self, rect : pygame.Rect):
+        r"""
+            A region that was drawn over outside the renderer this frame
+        """
+        self.dirty.append(rect)
+        self._drawn.append(rect)
+
+    def present(self):
+        r"""
+            Update the display where it changed. Without a background the
+            whole display is updated
+        """
+        if self.background is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(self.dirty)
+        self.dirty = []
+
     @staticmethod
-    def rotatePivoted(im, angle, pivot):
+    def rotatePivoted(path, size, angle, pivot):
         # rotate the leg image around the pivot
-        image = pygame.transform.rotate(im, angle)
+        image = rotations.get(path, size, angle)
         rect = image.get_rect()
         rect.center = pivot
         return image, rect
 
+    def _static_entities(self, order : List[Entity]) -> Tuple[List[Entity], set]:
+        still = self.still.entities
+
+        # The draw order is a new list whenever an entity comes or goes or
+        # its priority changes, which can move the cutoff
+        if self._static[0] is not still or self._static[1] is not order:
+            members = set(still)
+            cutoff = next((e.render.priority for e in order if e not in members), self.static_priority)
+            cutoff = min(cutoff, self.static_priority)
+
+            static = [e for e in still if e.render.priority <= cutoff]
+            if static != self._static[2]:
+                self._baked = None
+            self._static = (still, order, static, set(static))
+
+        return self._static[2], self._static[3]
+
+    def visible(self, entities : List[Entity]) -> List[Entity]:
+        r"""
+            The entities whose sprites intersect the camera's view, in the
+            same order. Entities without a position are always kept.
+
+            When there are many still sprites they are found through a
+            SpatialHash that is only rebuilt when one of them moves, so
+            only those near the view are tested. Everything else is tested
+            against the view directly
+        """
+        still = self.still.entities
+        if self._extents[0] is not entities or self._extents[1] is not still:
+            members = set(still)
+            placed = [i for i, e in enumerate(entities) if e.has(PositionComponent)]
+            fixed = [i for i in placed if entities[i] in members]
+
+            # A few still sprites are cheaper to test along with the rest
+            if len(fixed) < CULL_GRID:
+                fixed = []
+
+            self._extents = (
+                entities,
+                still,
+                sprites(entities, fixed),
+                sprites(entities, [i for i in placed if not fixed or entities[i] not in members]),
+                np.array([i for i, e in enumerate(entities) if not e.has(PositionComponent)], dtype=np.intp)
+            )
+
+        _, _, fixed, moving, unplaced = self._extents
+
+        # Debug markers are drawn a few pixels past the sprite
+        view = self.camera.view(margin=MARKER)
+        keep = [unplaced]
+
+        if len(fixed[1]):
+            positions = PositionComponent.store.array[self._fixed_rows.get(fixed[0])]
+            if self._grid[0] is None or not np.array_equal(positions, self._grid[0]):
+                grid = SpatialHash(CULL_CELL)
+                grid.insert_many(positions[:, [0, 0, 1, 1]] + fixed[2])
+                self._grid = (positions, grid)
+
+            near = np.fromiter(self._grid[1].query(*view), dtype=np.intp)
+            boxes = positions[near][:, [0, 0, 1, 1]] + fixed[2][near]
+            keep.append(fixed[1][near[in_view(boxes, view)]])
+
+        if len(moving[1]):
+            positions = PositionComponent.store.array[self._moving_rows.get(moving[0])]
+            boxes = positions[:, [0, 0, 1, 1]] + moving[2]
+            keep.append(moving[1][in_view(boxes, view)])
+
+        keep = np.concatenate(keep)
+        if len(keep) == len(entities):
+            return entities
+
+        keep.sort()
+        return [entities[i] for i in keep.tolist()]
+
+    def _bake(self, entities : List[Entity], skip : set):
+        self.layer = self.background.copy()
+        self.draw(self.layer, [e for e in entities if e in skip])
+
     def update(self, screen, width, height):
-        entities = self.get()
-        entities = sorted(entities, key=operator.attrgetter('render.priority'))
+        sync()
+
+        if self.camera is None:
+            self.camera = Camera(width, height)
+
+        order = self.order.entities
+        entities = self.visible(order)
+
+        if self.background is None:
+            self.draw(screen, entities)
+            return
+
+        static, skip = self._static_entities(order)
+        positions = PositionComponent.store.array[self._rows.get(static)]
+
+        # Moving the camera moves everything in the layer too
+        if self._baked is None or self._baked[1] != self.camera.state \
+                or not np.array_equal(positions, self._baked[0]):
+            self._bake(entities, skip)
+            self._baked = (positions, self.camera.state)
+
+            screen.blit(self.layer, (0, 0))
+            self.dirty.append(screen.get_rect())
+        elif self._drawn:
+            # Put back what was drawn over during the last frame
+            screen.blits([(self.layer, rect, rect) for rect in self._drawn], doreturn=False)
+            self.dirty.extend(self._drawn)
+
+        drawn = self.draw(screen, [e for e in entities if e not in skip])
+
+        self._drawn = drawn
+        self.dirty.extend(drawn)
+
+    def sprite(self, e : Entity) -> Tuple[pygame.Surface, tuple]:
+        r"""
+            The surface an entity is drawn with and where it goes
+        """
+        zoom = self.camera.zoom
+        size = e.render.size
+
+        cx, cy = 0, 0
+        if e.render.center is not None:
+            cx, cy = e.render.center
+
+        # Zoomed sprites are scaled once per size by the texture cache
+        if zoom != 1:
+            w, h = size if size is not None else textures.get(e.render.path).get_size()
+            size = (max(1, round(w * zoom)), max(1, round(h * zoom)))
+            cx, cy = cx * zoom, cy * zoom
+
+        # Loaded and scaled once, and shared between entities
+        img = textures.get(e.render.path, size)
+
+        x, y = self.camera.to_screen(e.position.x, e.position.y)
+
+        if e.has(RotateComponent) and e.render.center is not None:
+            angle = e.rotate.ut
+            img, rect = self.rotatePivoted(e.render.path, size, degrees(angle), (x, y))
+            rect.centerx -= cx / 2 * cos(angle)
+            rect.centery += cy * 2 * sin(angle)
+            return img, rect
+
+        return img, (x - cx, y - cy)
+
+    def draw(self, screen, entities : List[Entity]) -> List[pygame.Rect]:
+        r"""
+            Draw entities in the given order, returning the regions they
+            covered. The sprites go out in one Surface.blits call, then the
+            debug boxes, then the debug markers in another blits call
+        """
+        sprites = []
+        debug = []
 
         for e in entities:
-            if e.render.renderable:
-                # Draw the sprite
-                if e.has(PositionComponent) and e.render.path is not None:
-
-                    # Cache the original image instead of reading it from the file every loop
-                    if not hasattr(e.render, '_cached_img'):
-                        img = pygame.image.load(e.render.path).convert_alpha()
-                        e.render._cached_img = copy(img)
-                    else:
-                        img = e.render._cached_img
-
-                    x, y = cartesian_to_screen(e.position.x, e.position.y, width, height)
-                    rect = None
-
-                    if e.render.size is not None:
-                        img = pygame.transform.scale(img, e.render.size)
-
-                    cx, cy = 0, 0
-                    if e.render.center is not None:
-                        cx, cy = e.render.center
-
-                    if e.has(RotateComponent) and e.render.center is not None:
-                        angle = e.rotate.ut
-                        img, rect = self.rotatePivoted(img, degrees(angle), (x, y))
-                        rect.centerx -= e.render.center[0] / 2 * cos(angle)
-                        rect.centery += e.render.center[1] * 2 * sin(angle)
-
-                    if rect is not None:
-                        screen.blit(img, rect)
-                    else:
-                        screen.blit(img, (x - cx, y - cy))
-
-                # Draw the position
-                if e.has(PositionComponent) and e.render.debug:
-                    x, y = cartesian_to_screen(e.position.x, e.position.y, width, height)
-                    pygame.draw.circle(screen, RED, (x, y), 5)
-
-                # Draw the bounding box
-                if e.has(CollisionComponent) and e.render.debug:
-                    x1, y1 = cartesian_to_screen(e.collide.x1, e.collide.y1, width, height)
-                    x2, y2 = cartesian_to_screen(e.collide.x2, e.collide.y2, width, height)
-
-                    pygame.draw.circle(screen, BLUE, (x1, y1), 5)
-                    pygame.draw.circle(screen, BLUE, (x1, y2), 5)
-                    pygame.draw.circle(screen, BLUE, (x2, y1), 5)
-                    pygame.draw.circle(screen, BLUE, (x2, y2), 5)
-
-                    pygame.draw.line(screen, BLUE, (x1, y1), (x2, y1))
-                    pygame.draw.line(screen, BLUE, (x2, y1), (x2, y2))
-                    pygame.draw.line(screen, BLUE, (x1, y2), (x2, y2))
-                    pygame.draw.line(screen, BLUE, (x1, y1), (x1, y2))
\ No newline at end of file
+            if not e.render.renderable:
+                continue
+
+            if e.render.path is not None and e.has(PositionComponent):
+                sprites.append(self.sprite(e))
+
+            if e.render.debug:
+                debug.append(e)
+
+        rects = screen.blits(sprites) if sprites else []
+        if debug:
+            rects += self._debug(screen, debug)
+
+        return rects
+
+    def _debug(self, screen, entities : List[Entity]) -> List[pygame.Rect]:
+        # Positions and boxes are read from the stores for all entities at
+        # once instead of a property at a time
+        placed = np.array([e.has(PositionComponent) for e in entities], dtype=bool)
+        boxed = np.array([e.has(CollisionComponent) for e in entities], dtype=bool)
+
+        xy = np.zeros((len(entities), 2))
+        if placed.any():
+            slots = [e.index for e, p in zip(entities, placed.tolist()) if p]
+            xy[placed] = PositionComponent.store.array[PositionComponent.store.rows(slots)]
+
+        # The box around the current position, which may be newer than
+        # the one CollisionSystem last derived
+        bounds = np.zeros((len(entities), 4))
+        if boxed.any():
+            slots = [e.index for e, b in zip(entities, boxed.tolist()) if b]
+            box = CollisionComponent.store.array[CollisionComponent.store.rows(slots)]
+            anchored = placed[boxed] & ~np.isnan(box[:, 4])
+            box[anchored, :4] = xy[boxed][anchored][:, [0, 0, 1, 1]] + box[anchored, 4:]
+            bounds[boxed] = box[:, :4]
+
+        px, py = self.camera.to_screen(xy[:, 0], xy[:, 1])
+        x1, y1 = self.camera.to_screen(bounds[:, 0], bounds[:, 2])
+        x2, y2 = self.camera.to_screen(bounds[:, 1], bounds[:, 3])
+
+        boxes = []
+        markers = []
+        for (p, b, x, y, bx1, by1, bx2, by2) in zip(placed.tolist(), boxed.tolist(), px.tolist(), py.tolist(),
+                                                    x1.tolist(), y1.tolist(), x2.tolist(), y2.tolist()):
+            # The position
+            if p:
+                markers.append((marker(RED), (x - MARKER, y - MARKER)))
+
+            # The bounding box
+            if b:
+                corners = [(bx1, by1), (bx2, by1), (bx2, by2), (bx1, by2)]
+                boxes.append(corners)
+                markers.extend((marker(BLUE), (x - MARKER, y - MARKER)) for (x, y) in corners)
+
+        rects = [pygame.draw.lines(screen, BLUE, True, corners) for corners in boxes]
+        if markers:
+            rects += screen.blits(markers)
+
+        return rects
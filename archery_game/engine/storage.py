@@ -0,0 +1,158 @@
+from functools import wraps
+from typing import List
+
+import numpy as np
+
+
+class ColumnStore:
+    r"""
+        Keeps the fields of one component type in a contiguous float64
+        array with one row per entity, so systems can do math over whole
+        columns at once. Rows are kept dense: removing an entity moves the
+        last row into the hole it leaves behind.
+
+        Entities are addressed by their slot index (Entity.index), which
+        indexes the sparse slot -> row array directly
+    """
+
+    def __init__(self, columns: List[str], capacity: int = 64):
+        self.columns = tuple(columns)
+        self.index = {name: i for i, name in enumerate(self.columns)}
+
+        self.array = np.zeros((capacity, len(self.columns)))
+        self.size = 0
+
+        # Sparse set mapping between entity slots and dense rows
+        self.sparse = np.full(capacity, -1, dtype=np.intp)  # slot -> row
+        self.slots = []       # row -> slot
+        self.components = []  # row -> component
+
+        # Bumped whenever rows are added, removed or moved so that
+        # systems can tell when their cached row indices are stale
+        self.version = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, slot: int):
+        return slot < len(self.sparse) and self.sparse[slot] >= 0
+
+    @property
+    def data(self) -> np.ndarray:
+        # A view of the rows that are in use
+        return self.array[:self.size]
+
+    def column(self, name: str) -> np.ndarray:
+        return self.array[:self.size, self.index[name]]
+
+    def rows(self, slots) -> np.ndarray:
+        r"""
+            The row of each entity slot, for use as a fancy index into the array
+        """
+        return self.sparse[np.fromiter(slots, dtype=np.intp)]
+
+    def add(self, slot: int, component):
+        if self.size == len(self.array):
+            grown = np.zeros((2 * len(self.array), len(self.columns)))
+            grown[:self.size] = self.array[:self.size]
+            self.array = grown
+
+        if slot >= len(self.sparse):
+            grown = np.full(max(2 * len(self.sparse), slot + 1), -1, dtype=np.intp)
+            grown[:len(self.sparse)] = self.sparse
+            self.sparse = grown
+
+        r = self.size
+        self.array[r] = component._local
+        self.sparse[slot] = r
+        self.slots.append(slot)
+        self.components.append(component)
+        self.size += 1
+
+        component._store = self
+        component._row = r
+        self.version += 1
+
+    def remove(self, slot: int):
+        r = int(self.sparse[slot])
+        self.sparse[slot] = -1
+        last = self.size - 1
+
+        # The component keeps its last values after it is detached
+        component = self.components[r]
+        component._local = self.array[r].tolist()
+        component._store = None
+
+        if r != last:
+            self.array[r] = self.array[last]
+            moved = self.components[last]
+            moved._row = r
+            self.components[r] = moved
+            self.slots[r] = self.slots[last]
+            self.sparse[self.slots[r]] = r
+
+        self.components.pop()
+        self.slots.pop()
+        self.size -= 1
+        self.version += 1
+
+class RowCache:
+    r"""
+        Remembers the store rows of a query's entity list until either the
+        list or the store layout changes
+    """
+
+    def __init__(self, store: ColumnStore):
+        self.store = store
+        self.entities = None
+        self.version = -1
+        self.rows = None
+
+    def get(self, entities: list) -> np.ndarray:
+        # Queries hand back the same list until their membership changes
+        if entities is not self.entities or self.version != self.store.version:
+            self.rows = self.store.rows([e.index for e in entities])
+            self.entities = entities
+            self.version = self.store.version
+        return self.rows
+
+def _column_property(col: int) -> property:
+    def fget(self):
+        store = self._store
+        if store is None:
+            return self._local[col]
+        return store.array.item(self._row, col)
+
+    def fset(self, value):
+        store = self._store
+        if store is None:
+            self._local[col] = value
+        else:
+            store.array[self._row, col] = value
+
+    return property(fget, fset)
+
+def columnar(*columns: str):
+    r"""
+        Class decorator for component dataclasses whose float fields should
+        live in a shared ColumnStore. Attribute access such as
+        e.position.x keeps working and reads or writes the store's row
+        while the component is attached to an entity
+    """
+    def wrap(cls):
+        for i, name in enumerate(columns):
+            setattr(cls, name, _column_property(i))
+
+        init = cls.__init__
+
+        @wraps(init)
+        def __init__(self, *args, **kwargs):
+            self._store = None
+            self._local = [0.0] * len(columns)
+            init(self, *args, **kwargs)
+
+        cls.__init__ = __init__
+        cls.store = ColumnStore(columns)
+        return cls
+
+    return wrap
@@ -1,16 +1,22 @@
+import os
 from enum import unique
-from itertools import combinations
 from math import atan2, cos, sin
-from typing import Callable, List
+from typing import Callable, List, Tuple
 
+import numpy as np
 import pygame
 from archery_game.engine.components import (CollisionComponent, CollisionType,
+                                            ControlComponent,
                                             CustomMotionComponent,
                                             NameComponent, PairedComponent,
                                             PositionComponent, RotateComponent,
-                                            ShooterComponent,
+                                            ShooterComponent, SleepComponent,
                                             VelocityComponent, AccelerationComponent)
-from archery_game.engine.ecs import Entity, System, Event
+from archery_game.engine.assets import texts
+from archery_game.engine.broadphase import SpatialHash
+from archery_game.engine.ecs import (Entity, Query, System, commands, events,
+                                     sync)
+from archery_game.engine.storage import RowCache
 
 
 class RotateSystem(System):
@@ -31,65 +37,455 @@ class RotateSystem(System):
                 e.rotate.ut = atan2(e.rotate.uy, e.rotate.ux)
 
 class PhysicsSystem(System):
-    def __init__(self):
+    r"""
+        Integrates velocity and position one axis at a time. By default
+        every body is advanced with a few array operations over the
+        component stores; pass vectorized=False to step each entity in
+        plain Python instead
+    """
+
+    def __init__(self, vectorized : bool = True):
         super().__init__()
 
+        self.vectorized = vectorized
+
         self.subscribe(PositionComponent)
         self.subscribe(VelocityComponent)
+        self.exclude(SleepComponent)
+
+        # Row indices into the component stores, rebuilt only when
+        # the entities or the store layouts change
+        self._rows = (
+            RowCache(PositionComponent.store),
+            RowCache(VelocityComponent.store),
+            RowCache(AccelerationComponent.store)
+        )
 
     def update(self, mode : str, dt : float = 0.01):
+        if self.vectorized:
+            self._update_vectorized(mode, dt)
+            return
+
         entities = self.get()
+        self._accelerated(entities)
 
         for e in entities:
-            if not e.has(AccelerationComponent):
-                e.attach(AccelerationComponent())
-
             ax = e.accel.ax
             ay = e.accel.ay
 
             if mode == 'x':
                 e.velocity.vx += ax * dt
                 e.position.x += e.velocity.vx * dt
-                if e.has(CollisionComponent):
-                    e.collide.x1 += e.velocity.vx * dt
-                    e.collide.x2 += e.velocity.vx * dt
 
             elif mode == 'y':
                 e.velocity.vy += ay * dt
                 e.position.y += e.velocity.vy * dt
-                if e.has(CollisionComponent):
-                    e.collide.y1 += e.velocity.vy * dt
-                    e.collide.y2 += e.velocity.vy * dt
+
+    def _accelerated(self, entities : List[Entity]):
+        # Bodies without an acceleration get the default gravity
+        accelerated = Query.of([PositionComponent, VelocityComponent, AccelerationComponent],
+                               exclude=[SleepComponent])
+        if len(accelerated) != len(entities):
+            for e in entities:
+                if not e.has(AccelerationComponent):
+                    commands.attach(e, AccelerationComponent())
+
+            # Apply them before integrating, since every body needs one
+            sync()
+
+    def _update_vectorized(self, mode : str, dt : float):
+        entities = self.get()
+        if not entities:
+            return
+
+        self._accelerated(entities)
+        p, v, a = (rows.get(entities) for rows in self._rows)
+
+        pos = PositionComponent.store.array
+        vel = VelocityComponent.store.array
+        acc = AccelerationComponent.store.array
+
+        if mode == 'x':
+            axis = 0
+        elif mode == 'y':
+            axis = 1
+        else:
+            return
+
+        vel[v, axis] += acc[a, axis] * dt
+        pos[p, axis] += vel[v, axis] * dt
 
 class TrackTrajectorySystem(System):
-    def __init__(self, exclusive: List[str] = []):
+    r"""
+        Records the positions of every entity, or only of the ids in
+        `exclusive`. Each one keeps its last `capacity` positions in a
+        ring buffer shared by all tracked entities, so memory does not
+        grow with the length of a run. Entities that are no longer
+        tracked give their slot back, along with what was recorded of them.
+
+        With `spill` set to a directory, the buffer is saved there as an
+        .npz chunk every time it wraps around, and untracked entities keep
+        their slot until then. Call flush() at the end of a run to save
+        what was recorded since the last chunk. `load` stitches the chunks
+        together again
+    """
+
+    def __init__(self, exclusive: List[int] = [], capacity: int = 4096, spill: str = None):
         super().__init__()
-        
+
+        assert capacity > 0, 'TrackTrajectorySystem: capacity must be positive'
+
         self.subscribe(PositionComponent)
-        self.entities = {}
-        self.exclusive = exclusive
+        self.exclusive = set(exclusive)
+        self.capacity = capacity
+        self.spill = spill
+        self.chunks = 0
+        # Frames before this one have been saved to a chunk
+        self.saved = 0
+
+        # Updates recorded so far. Row frame % capacity of the buffer is
+        # written on each update
+        self.frame = 0
+
+        self.positions = np.zeros((0, capacity, 2))
+        self.slots = {}                           # entity id -> slot
+        self.ids = []                             # slot -> entity id, None if free
+        self.first = np.zeros(0, dtype=np.int64)  # slot -> first frame recorded
+        self.last = np.zeros(0, dtype=np.int64)   # slot -> frame after the last one
+        self.free = []
+
+        self._entities = None
+        self._tracked = []
+        self._tracked_slots = np.zeros(0, dtype=np.intp)
+        self._rows = RowCache(PositionComponent.store)
+
+    def _slot(self, id : int) -> int:
+        if not self.free:
+            n = len(self.ids)
+            grow = max(n, 8)
+            self.positions = np.concatenate([self.positions, np.zeros((grow, self.capacity, 2))])
+            self.first = np.concatenate([self.first, np.zeros(grow, dtype=np.int64)])
+            self.last = np.concatenate([self.last, np.zeros(grow, dtype=np.int64)])
+            self.ids += [None] * grow
+            self.free = list(range(n + grow - 1, n - 1, -1))
+
+        slot = self.free.pop()
+        self.slots[id] = slot
+        self.ids[slot] = id
+        self.first[slot] = self.frame
+        self.last[slot] = self.frame
+        return slot
+
+    def _release(self, tracked : List[Entity]):
+        tracked = {e.id for e in tracked}
+        for id in [id for id in self.slots if id not in tracked]:
+            slot = self.slots.pop(id)
+            self.ids[slot] = None
+            self.free.append(slot)
+
+    def _rebuild(self, entities : List[Entity]):
+        exclusive = self.exclusive
+        tracked = [e for e in entities if not exclusive or e.id in exclusive]
+
+        # Without a spill there is nowhere for the rest of their
+        # trajectory to go
+        if self.spill is None:
+            self._release(tracked)
+
+        for e in tracked:
+            slot = self.slots.get(e.id)
+            if slot is None:
+                slot = self._slot(e.id)
+
+            # Tracking restarts after a gap. What was recorded before it
+            # and not spilled yet is saved as a chunk of its own first
+            if self.last[slot] != self.frame:
+                if self.spill is not None and self.last[slot] > self.saved:
+                    self._save([slot], max(int(self.first[slot]), self.saved), int(self.last[slot]))
+
+                self.first[slot] = self.frame
+                self.last[slot] = self.frame
+
+        self._tracked = tracked
+        self._tracked_slots = np.array([self.slots[e.id] for e in tracked], dtype=np.intp)
+        self._entities = entities
 
     def update(self):
         entities = self.get()
 
-        for e in entities:
-            if (len(self.exclusive) > 0 and e.id in self.exclusive) or not self.exclusive:                    
-                if e.id not in self.entities:
-                    self.entities[e.id] = {'x' : [], 'y' : []}
+        # Only look at the ids when the set of entities changes
+        if entities is not self._entities:
+            self._rebuild(entities)
+
+        if self._tracked:
+            slots = self._tracked_slots
+            rows = self._rows.get(self._tracked)
+            self.positions[slots, self.frame % self.capacity] = PositionComponent.store.array[rows]
+            self.last[slots] = self.frame + 1
+
+        self.frame += 1
+
+        if self.spill is not None and self.frame % self.capacity == 0:
+            self.flush()
+
+    def flush(self):
+        r"""
+            Save what was recorded since the last chunk as the next one and
+            free the slots of entities that are no longer tracked. Called
+            every time the buffer wraps around; call it once more when the
+            run ends so the last, partial chunk isn't lost
+        """
+        if self.spill is None or self.frame == self.saved:
+            return
+
+        start = self.saved
+        used = [s for s, id in enumerate(self.ids) if id is not None and self.last[s] > start]
+
+        self._save(used, start, self.frame)
+        self.saved = self.frame
+
+        self._release(self._tracked)
+
+    def _save(self, slots : List[int], start : int, end : int):
+        # Frames start to end of the given slots, as the next chunk
+        os.makedirs(self.spill, exist_ok=True)
+        np.savez(
+            os.path.join(self.spill, 'chunk_{:06d}.npz'.format(self.chunks)),
+            start = start,
+            ids = np.array([self.ids[s] for s in slots], dtype=np.int64),
+            first = np.maximum(self.first[slots], start),
+            last = np.minimum(self.last[slots], end),
+            # Row i holds frame start + i
+            positions = self.positions[slots][:, np.arange(start, end) % self.capacity]
+        )
+        self.chunks += 1
+
+    def trajectory(self, id : int) -> np.ndarray:
+        r"""
+            The (n, 2) positions of an entity that are still in the buffer,
+            oldest first
+        """
+        slot = self.slots.get(id)
+        if slot is None:
+            return np.zeros((0, 2))
+
+        last = int(self.last[slot])
+        start = max(int(self.first[slot]), last - self.capacity)
+        return self.positions[slot, np.arange(start, last) % self.capacity]
+
+    @property
+    def entities(self) -> dict:
+        r"""
+            entity id -> {'x' : xs, 'y' : ys} for everything in the buffer
+        """
+        trajectories = {}
+        for id in self.slots:
+            points = self.trajectory(id)
+            trajectories[id] = {'x' : points[:, 0], 'y' : points[:, 1]}
+        return trajectories
+
+    @staticmethod
+    def load(spill : str) -> dict:
+        r"""
+            entity id -> (n, 2) positions, read back from the chunks in `spill`
+        """
+        parts = {}
+        for name in sorted(os.listdir(spill)):
+            if not (name.startswith('chunk_') and name.endswith('.npz')):
+                continue
+
+            with np.load(os.path.join(spill, name)) as chunk:
+                start = int(chunk['start'])
+                for id, first, last, points in zip(chunk['ids'].tolist(), chunk['first'].tolist(),
+                                                   chunk['last'].tolist(), chunk['positions']):
+                    parts.setdefault(id, []).append(points[first - start:last - start])
+
+        return {id : np.concatenate(p) for id, p in parts.items()}
+
+# Any of these can move a body, so it can't live in the static index
+MOVERS = [VelocityComponent, CustomMotionComponent, ControlComponent, PairedComponent]
+
+def is_static(e : Entity) -> bool:
+    r"""
+        Rigid bodies that nothing can move. The collision type is read
+        once when the entity's components change, so it should not be
+        edited after the CollisionComponent is attached
+    """
+    return e.collide.ctype == CollisionType.RIGID \
+        and not any(e.has(c) for c in MOVERS)
+
+def is_dynamic(e : Entity) -> bool:
+    return not is_static(e) and not e.has(SleepComponent)
+
+def is_resting(e : Entity) -> bool:
+    # Sleeping bodies that a touch can wake. Pinned ones are left out
+    return e.has(SleepComponent) and not e.sleep.pinned
+
+def is_continuous(e : Entity) -> bool:
+    return e.collide.continuous
+
+# The events that need CollisionSystem to keep track of contacts
+CONTACT_EVENTS = ('collision_enter', 'collision_stay', 'collision_exit')
+
+# How far a swept body is left inside what it hit, so the regular
+# overlap test picks the contact up
+CONTACT_SKIN = 1e-3
+
+def group_by_layer(entities : List[Entity]) -> dict:
+    r"""
+        (layer, mask) -> indices into entities
+    """
+    groups = {}
+    for i, e in enumerate(entities):
+        groups.setdefault((int(e.collide.layer), int(e.collide.mask)), []).append(i)
+
+    return {key : np.array(idx, dtype=np.intp) for key, idx in groups.items()}
+
+def layers_compatible(g1 : Tuple[int, int], g2 : Tuple[int, int]) -> bool:
+    # Each (layer, mask) group's layer must be in the other's mask
+    return bool((g1[0] & g2[1]) and (g2[0] & g1[1]))
+
+def overlapping(a : np.ndarray, b : np.ndarray) -> np.ndarray:
+    r"""
+        CollisionSystem.is_collision, row by row, for two (n, 4) arrays
+        of x1, x2, y1, y2 bounds
+    """
+    return (a[:, 0] < b[:, 1]) & (a[:, 1] > b[:, 0]) \
+        & (a[:, 2] > b[:, 3]) & (a[:, 3] < b[:, 2])
+
+class BodyIndex:
+    r"""
+        Spatial hashes over a set of bodies that don't move on their own,
+        one per (layer, mask) group. Rebuilt only when the set changes or
+        one of the bodies' bounds does
+    """
+
+    def __init__(self, query : Query, cell_size : float):
+        self.query = query
+        self.cell_size = cell_size
+
+        self.entities = []
+        self.hashes = {}
+        self.bounds = np.zeros((0, 4))
+
+        self._rows = RowCache(CollisionComponent.store)
+
+    def refresh(self) -> List[Entity]:
+        entities = self.query.entities
+        bounds = CollisionComponent.store.array[self._rows.get(entities), :4]
 
-                self.entities[e.id]['x'] += [ e.position.x ]
-                self.entities[e.id]['y'] += [ e.position.y ]
+        if entities is self.entities and np.array_equal(bounds, self.bounds):
+            return entities
+
+        self.hashes = {}
+        for key, idx in group_by_layer(entities).items():
+            self.hashes[key] = SpatialHash(self.cell_size)
+            self.hashes[key].insert_many(bounds[idx], idx.tolist())
+
+        self.entities = entities
+        self.bounds = bounds
+        return entities
+
+    def query_box(self, group : Tuple[int, int], box : List[float]) -> set:
+        r"""
+            Indices of the bodies near the box that the group can collide with
+        """
+        found = set()
+        for key, index in self.hashes.items():
+            if layers_compatible(group, key):
+                found |= index.query(*box)
+        return found
 
 class CollisionSystem(System):
     r"""
-        Find collisions
+        Find collisions. Bodies are split into static, dynamic and sleeping
+        ones. Static and sleeping bodies live in prebuilt spatial hashes
+        that are only rebuilt when one of them changes, dynamic bodies are
+        hashed every update, and only pairs with at least one dynamic body
+        are tested. A dynamic body touching a sleeping one wakes it.
+
+        Each set is further bucketed by collision layer and mask, so
+        pairs whose layers exclude each other are never enumerated
     """
     
-    def __init__(self):
+    def __init__(self, cell_size : float = 64.0, stay_interval : int = None):
         super().__init__()
 
         self.subscribe(CollisionComponent)
 
+        self.cell_size = cell_size
+
+        # Touching pairs, keyed by their sorted entity ids. New pairs post
+        # 'collision_enter' and separated pairs post 'collision_exit'.
+        # 'collision_stay' is posted every stay_interval updates, or never.
+        # Contacts are only tracked while one of those has a subscriber
+        self.contacts = {}
+        self.stay_interval = stay_interval
+
+        # Contacts with a sleeping body can't end until it wakes, so they
+        # are parked under each sleeping body's id and put back by wake()
+        self.parked = {}
+        self._members = None
+        events.subscribe('wake', self._unpark)
+
+        self.static = Query.of([CollisionComponent], where=is_static)
+        self.dynamic = Query.of([CollisionComponent], where=is_dynamic)
+        self.resting = Query.of([CollisionComponent], where=is_resting)
+        self.continuous = Query.of([CollisionComponent, VelocityComponent, PositionComponent],
+                                   exclude=[SleepComponent], where=is_continuous)
+
+        self.static_index = BodyIndex(self.static, cell_size)
+        self.resting_index = BodyIndex(self.resting, cell_size)
+
+        # (layer, mask) -> spatial hash of the dynamic bodies
+        self.broadphase = {}
+
+        self._dynamic_rows = RowCache(CollisionComponent.store)
+        self._dynamic_groups = (None, None)
+
+        self._continuous_rows = (
+            RowCache(CollisionComponent.store),
+            RowCache(VelocityComponent.store),
+            RowCache(PositionComponent.store)
+        )
+        self._sweep_groups = (None, None, None, None, None)
+
+        self.placed = Query.of([CollisionComponent, PositionComponent])
+        self._placed_rows = (RowCache(CollisionComponent.store), RowCache(PositionComponent.store))
+
+    def place_bounds(self):
+        r"""
+            Derive the world box of every body that has a position from
+            its offsets, in one pass over the stores
+        """
+        entities = self.placed.entities
+        if not entities:
+            return
+
+        rows = self._placed_rows[0].get(entities)
+        origin = PositionComponent.store.array[self._placed_rows[1].get(entities)][:, [0, 0, 1, 1]]
+
+        boxes = CollisionComponent.store.array
+        offsets = boxes[rows, 4:]
+
+        # Boxes that were attached before their entity had a position
+        pending = np.isnan(offsets[:, 0])
+        if pending.any():
+            offsets[pending] = boxes[rows[pending], :4] - origin[pending]
+            boxes[rows[pending], 4:] = offsets[pending]
+
+        boxes[rows, :4] = origin + offsets
+
+    def _dynamic(self) -> Tuple[List[Entity], dict, np.ndarray]:
+        dynamic = self.dynamic.entities
+
+        # The layer groups are kept until the dynamic set changes
+        if self._dynamic_groups[0] is not dynamic:
+            self._dynamic_groups = (dynamic, group_by_layer(dynamic))
+
+        bounds = CollisionComponent.store.array[self._dynamic_rows.get(dynamic), :4]
+        return dynamic, self._dynamic_groups[1], bounds
+
     @staticmethod
     def is_collision(e1 : Entity, e2 : Entity):
         return (e1.collide.x1 < e2.collide.x2) \
@@ -107,70 +503,575 @@ class CollisionSystem(System):
         return (e1.collide.y1 > e2.collide.y2) \
             and (e1.collide.y2 < e2.collide.y1)
 
-    def update(self, mode : str, **kwargs):
-        entities = self.get()
+    def _candidates(self) -> List[Tuple[List[Entity], np.ndarray, np.ndarray, np.ndarray]]:
+        r"""
+            Candidate pairs as index arrays: for each of the dynamic,
+            static and sleeping sets, (others, their bounds, i, j) where i
+            indexes the dynamic bodies and j indexes `others`
+        """
+        static = self.static_index.refresh()
+        resting = self.resting_index.refresh()
+        dynamic, groups, bounds = self._dynamic()
+        boxes = bounds.tolist()
+
+        # A group is only hashed if some group, itself included, looks
+        # it up, so groups that can't collide with anything dynamic cost
+        # nothing here
+        self.broadphase = {}
+
+        def hashed(key):
+            if key not in self.broadphase:
+                self.broadphase[key] = SpatialHash(self.cell_size)
+                self.broadphase[key].insert_many(bounds[groups[key]], groups[key].tolist())
+            return self.broadphase[key]
+
+        # Pairs are gathered as i * n + j keys, which sort into the same
+        # order as (i, j) and are deduplicated without a tuple per pair
+        n = len(dynamic)
+        found = []
+        crossing = []
+        keys = list(groups)
+        for a, ka in enumerate(keys):
+            for kb in keys[a:]:
+                if not layers_compatible(ka, kb):
+                    continue
+
+                if ka == kb:
+                    I, J = hashed(ka).pair_array()
+                    found.append(I * n + J)
+                    continue
+
+                # Walk the smaller group and look it up in the other's hash
+                small, large = (ka, kb) if len(groups[ka]) <= len(groups[kb]) else (kb, ka)
+                index = hashed(large)
+                for i in groups[small].tolist():
+                    crossing += [i * n + j if i < j else j * n + i for j in index.query(*boxes[i])]
+
+        found.append(np.array(crossing, dtype=np.int64))
+        sets = [(dynamic, bounds, np.unique(np.concatenate(found)), n)]
+
+        for (index, others) in ((self.static_index, static), (self.resting_index, resting)):
+            if not others:
+                continue
+
+            m = len(others)
+            found = []
+            for ka, idx in groups.items():
+                for i in idx.tolist():
+                    found += [i * m + j for j in index.query_box(ka, boxes[i])]
+
+            sets.append((others, index.bounds, np.unique(np.array(found, dtype=np.int64)), m))
+
+        candidates = []
+        for (others, other_bounds, found, m) in sets:
+            candidates.append((others, other_bounds, found // m, found % m))
+
+        return candidates
+
+    def candidates(self) -> List[Tuple[Entity, Entity]]:
+        r"""
+            Pairs of entities whose boxes share a spatial hash cell and
+            whose layers and masks let them collide. The first entity of
+            every pair is dynamic, and dynamic-dynamic pairs come first,
+            then dynamic-static, then dynamic-sleeping
+        """
+        dynamic = self.dynamic.entities
+        return [
+            (dynamic[i], others[j])
+            for (others, _, I, J) in self._candidates()
+            for (i, j) in zip(I.tolist(), J.tolist())
+        ]
+
+    def overlaps(self) -> List[Tuple[Entity, Entity]]:
+        r"""
+            The candidate pairs whose boxes overlap, in the same order.
+            The boxes are tested as arrays, so only real hits are looked
+            at one by one
+        """
+        dynamic, _, bounds = self._dynamic()
+
+        pairs = []
+        for (others, other_bounds, I, J) in self._candidates():
+            if len(I) == 0:
+                continue
+
+            hit = overlapping(bounds[I], other_bounds[J])
+            pairs += [(dynamic[i], others[j]) for (i, j) in zip(I[hit].tolist(), J[hit].tolist())]
+
+        return pairs
+
+    def sweep(self, mode : str, dt : float):
+        r"""
+            Continuous collision for bodies flagged as continuous. Each one
+            has just moved velocity * dt along the axis, so its box is swept
+            back over that path, and if it would have passed into something
+            on the way it is moved back to the earliest time of impact.
+            The swept boxes are looked up in the spatial hashes of the
+            layer groups they can collide with, and the time of impact is
+            only computed for the pairs found there
+        """
+        movers = self.continuous.entities
+        if not movers:
+            return
+
+        # Bounds are stored as x1 (left), x2 (right), y1 (top), y2 (bottom)
+        axis, lo, hi = (0, 0, 1) if mode == 'x' else (1, 3, 2)
+
+        boxes = CollisionComponent.store.array
+        rows = self._continuous_rows[0].get(movers)
+        box = boxes[rows, :4]
+        d = VelocityComponent.store.array[self._continuous_rows[1].get(movers), axis] * dt
+
+        # Anything shorter than the box itself was already covered by
+        # the overlap tests of the previous and current step
+        fast = np.abs(d) > box[:, hi] - box[:, lo]
+        if not fast.any():
+            return
+
+        static = self.static_index.refresh()
+        resting = self.resting_index.refresh()
+        dynamic, groups, dynamic_bounds = self._dynamic()
+
+        # The movers' layer groups and the entity slots, used to keep a
+        # mover from hitting itself, are kept until either set changes
+        cached = self._sweep_groups
+        if cached[0] is not movers or cached[1] is not dynamic:
+            self._sweep_groups = (
+                movers, dynamic, group_by_layer(movers),
+                np.array([e.index for e in movers], dtype=np.intp),
+                np.array([e.index for e in dynamic], dtype=np.intp)
+            )
+        _, _, mover_groups, mover_slots, dynamic_slots = self._sweep_groups
+
+        start = box.copy()
+        start[:, lo] -= d
+        start[:, hi] -= d
+
+        swept = box.copy()
+        swept[:, lo] = np.minimum(box[:, lo], start[:, lo])
+        swept[:, hi] = np.maximum(box[:, hi], start[:, hi])
+
+        # Fast movers by layer group, and only the dynamic groups one of
+        # them can hit get hashed
+        fast_groups = {}
+        for key, idx in mover_groups.items():
+            idx = idx[fast[idx]]
+            if len(idx):
+                fast_groups[key] = idx.tolist()
+
+        dynamic_hashes = {}
+        for key, idx in groups.items():
+            if any(layers_compatible(key, k) for k in fast_groups):
+                dynamic_hashes[key] = SpatialHash(self.cell_size)
+                dynamic_hashes[key].insert_many(dynamic_bounds[idx], idx.tolist())
+
+        # Body indices run over the static, sleeping and dynamic bodies
+        # in that order
+        first_dynamic = len(static) + len(resting)
+        sets = (
+            (self.static_index.hashes, 0),
+            (self.resting_index.hashes, len(static)),
+            (dynamic_hashes, first_dynamic)
+        )
 
-        if mode == 'x':
-            for (e1, e2) in combinations(entities, 2):
-                if self.is_collision(e1, e2):
-                    collision_x_handler(e1.id, e2.id)
-                    if not (e1.collide.ctype == e2.collide.ctype == CollisionType.SLIDE):
-                        collision_x_handler(e2.id, e1.id)
+        areas = swept.tolist()
+        found = []
+        for km, idx in fast_groups.items():
+            for (hashes, offset) in sets:
+                for key, index in hashes.items():
+                    if not layers_compatible(km, key):
+                        continue
+                    for i in idx:
+                        found += [(i, offset + j) for j in index.query(*areas[i])]
+
+        if not found:
+            return
+
+        ij = np.array(found, dtype=np.intp)
+        I, J = ij[:, 0], ij[:, 1]
+
+        b = np.vstack([self.static_index.bounds, self.resting_index.bounds, dynamic_bounds])[J]
+        st = start[I]
+        dd = d[I]
+
+        hit = overlapping(swept[I], b)
+        own = J >= first_dynamic
+        hit[own] &= dynamic_slots[J[own] - first_dynamic] != mover_slots[I[own]]
+
+        # Only bodies that were still ahead of the mover at the start
+        ahead = np.where(dd > 0, st[:, hi] <= b[:, lo], st[:, lo] >= b[:, hi])
+        t = np.where(dd > 0, b[:, lo] - st[:, hi], b[:, hi] - st[:, lo]) / dd
+
+        hit &= ahead
+        toi = np.ones(len(movers))
+        np.minimum.at(toi, I[hit], t[hit])
 
-                    # fire a collision event
-                    Event('collision').fire(e1 = e1, e2 = e2, mode=mode)
+        hitting = np.flatnonzero(toi < 1.0)
+        if len(hitting) == 0:
+            return
 
+        step = -(1.0 - toi[hitting]) * d[hitting] + np.copysign(CONTACT_SKIN, d[hitting])
+
+        moved = rows[hitting]
+        boxes[moved, lo] += step
+        boxes[moved, hi] += step
+
+        positions = self._continuous_rows[2].get(movers)[hitting]
+        PositionComponent.store.array[positions, axis] += step
+
+    @staticmethod
+    def needs_resolution(e1 : Entity, e2 : Entity) -> bool:
+        r"""
+            Whether the handlers would do anything for this pair. Only
+            sliding bodies get pushed apart, and only sticky bodies that
+            are not paired yet attach to what they hit
+        """
+        for e in (e1, e2):
+            if e.collide.ctype == CollisionType.SLIDE:
+                return True
+            if e.collide.ctype == CollisionType.STICK and not e.has(PairedComponent):
+                return True
+        return False
+
+    def update(self, mode : str, dt : float = None, **kwargs):
+        members = self.get()
+
+        # Parked contacts go with a body that left the collider
+        if members is not self._members:
+            self._members = members
+            if self.parked:
+                self._prune()
+
+        if mode == 'x':
+            handler = collision_x_handler
         elif mode == 'y':
-            for (e1, e2) in combinations(entities, 2):
-                if self.is_collision(e1, e2):
-                    collision_y_handler(e1.id, e2.id)
-                    if not (e1.collide.ctype == e2.collide.ctype == CollisionType.SLIDE):
-                        collision_y_handler(e2.id, e1.id)
+            handler = collision_y_handler
+        else:
+            return
+
+        self.place_bounds()
+
+        if dt is not None:
+            self.sweep(mode, dt)
+
+        touching = set()
+        resolved = False
+
+        # Most overlaps persist from one update to the next, so the contact
+        # bookkeeping and the 'collision' event are skipped unless someone
+        # listens for them
+        tracking = any(events.has_subscribers(name) for name in CONTACT_EVENTS)
+        reporting = events.has_subscribers('collision')
+
+        if not tracking:
+            self.contacts = {}
+            self.parked = {}
+
+        # A subclass that redefines is_collision has it called on every
+        # candidate instead of the array test
+        custom = type(self).is_collision is not CollisionSystem.is_collision
+
+        for (e1, e2) in (self.candidates() if custom else self.overlaps()):
+            # Resolving an earlier pair may have pushed one of them clear
+            if (custom or resolved) and not self.is_collision(e1, e2):
+                continue
+
+            # Only the second body of a pair can be asleep
+            if e2.has(SleepComponent):
+                wake(e2)
+
+            if self.needs_resolution(e1, e2):
+                handler(e1.id, e2.id)
+                if not (e1.collide.ctype == e2.collide.ctype == CollisionType.SLIDE):
+                    handler(e2.id, e1.id)
+                resolved = True
+
+            if tracking:
+                key = (e1.id, e2.id) if e1.id < e2.id else (e2.id, e1.id)
+                touching.add(key)
+                self._touch(key, e1, e2, mode)
+
+            # queue a collision event for the next sync point
+            if reporting:
+                events.post('collision', e1 = e1, e2 = e2, mode=mode)
+
+        if tracking:
+            self._release(touching, mode)
+
+    def _touch(self, key : Tuple[int, int], e1 : Entity, e2 : Entity, mode : str):
+        contact = self.contacts.get(key)
+
+        if contact is None:
+            self.contacts[key] = Contact(e1, e2, {mode})
+            events.post('collision_enter', e1 = e1, e2 = e2, mode=mode)
+            return
+
+        contact.modes.add(mode)
+        contact.updates += 1
+        if self.stay_interval and contact.updates % self.stay_interval == 0:
+            events.post('collision_stay', e1 = contact.e1, e2 = contact.e2, mode=mode)
+
+    def _release(self, touching : set, mode : str):
+        # A contact ends once it has stopped touching on every axis.
+        # Pairs that are no longer tested because a body fell asleep
+        # are still touching, so they are parked until it wakes
+        for key in [k for k in self.contacts if k not in touching]:
+            contact = self.contacts[key]
+            sleeping = [e for e in (contact.e1, contact.e2) if e.has(SleepComponent)]
+            if sleeping:
+                del self.contacts[key]
+                for e in sleeping:
+                    self.parked.setdefault(e.id, {})[key] = contact
+                continue
+
+            contact.modes.discard(mode)
+
+            if not contact.modes:
+                del self.contacts[key]
+                events.post('collision_exit', e1 = contact.e1, e2 = contact.e2, mode=mode)
+
+    def _prune(self):
+        for id in list(self.parked):
+            parked = self.parked[id]
+            for key in [k for k, c in parked.items()
+                        if not (c.e1.has(CollisionComponent) and c.e2.has(CollisionComponent))]:
+                del parked[key]
+
+            if not parked:
+                del self.parked[id]
+
+    def _unpark(self, entity : Entity):
+        for key, contact in self.parked.pop(entity.id, {}).items():
+            # The other body may be parked on it too
+            other = contact.e2 if contact.e1 is entity else contact.e1
+            parked = self.parked.get(other.id)
+            if parked is not None:
+                parked.pop(key, None)
+                if not parked:
+                    del self.parked[other.id]
+
+            self.contacts[key] = contact
+
+class Contact:
+    r"""
+        Two bodies that are touching, as tracked by CollisionSystem
+    """
+
+    def __init__(self, e1 : Entity, e2 : Entity, modes : set):
+        self.e1 = e1
+        self.e2 = e2
+        # The axes on which the pair overlapped during their last update
+        self.modes = modes
+        # How many updates the contact has lasted
+        self.updates = 0
+
+def wake(e : Entity):
+    r"""
+        Put a sleeping body back into the simulation at the next sync point
+    """
+    if e.has(SleepComponent):
+        commands.dettach(e, SleepComponent)
+        events.fire('wake', entity=e)
+
+def apply_impulse(e : Entity, jx : float, jy : float):
+    r"""
+        Kick a body's velocity, waking it up if it was asleep
+    """
+    e.velocity.vx += jx
+    e.velocity.vy += jy
+    wake(e)
+
+class SleepSystem(System):
+    r"""
+        Takes bodies that have stopped moving out of the simulation.
+        Bodies slower than `threshold` for `frames` updates in a row fall
+        asleep: PhysicsSystem stops integrating them and CollisionSystem
+        stops testing them against anything but awake bodies, which wake
+        them on contact. Paired bodies are held in place by PairedSystem,
+        so they are pinned asleep straight away and leave collision too
+    """
+
+    def __init__(self, threshold : float = 1e-2, frames : int = 30):
+        super().__init__()
+
+        self.threshold = threshold
+        self.frames = frames
+
+        self.subscribe(VelocityComponent)
+        self.exclude(SleepComponent)
+        # Moved by something other than their velocity
+        self.exclude(CustomMotionComponent)
+        self.exclude(ControlComponent)
+
+        self.paired = Query.of([VelocityComponent, PairedComponent], exclude=[SleepComponent])
+
+        # Entity -> how many updates in a row it has been still
+        self.still = {}
+        self._rows = RowCache(VelocityComponent.store)
+
+    def update(self):
+        for e in self.paired.entities:
+            commands.attach(e, SleepComponent(pinned=True))
 
-                    Event('collision').fire(e1 = e1, e2 = e2, mode=mode)
+        entities = self.get()
+        if not entities:
+            self.still = {}
+            return
+
+        velocity = VelocityComponent.store.array[self._rows.get(entities)]
+        slow = np.flatnonzero((velocity ** 2).sum(axis=1) < self.threshold ** 2)
+
+        still = {}
+        for i in slow.tolist():
+            e = entities[i]
+            still[e] = self.still.get(e, 0) + 1
+
+            if still[e] >= self.frames:
+                commands.attach(e, SleepComponent())
+                del still[e]
+
+        # Anything that moved this update starts counting again
+        self.still = still
 
 class PairedSystem(System):
+    r"""
+        Keeps paired entities at a fixed offset from the entity they are
+        paired to. Pairings form a hierarchy that is walked from the top
+        down, and asleep children are only rewritten when their parent
+        moved since the last update. A parent that stayed put only looks
+        at its awake children and the children that are parents too, so
+        a still subtree of sleeping bodies costs next to nothing
+    """
+
     def __init__(self):
         super().__init__()
 
         self.subscribe(PairedComponent)
         self.subscribe(PositionComponent)
 
+        self.children = {}  # parent id -> paired entities
+        self.roots = []     # parents that are not paired themselves
+        self.seen = {}      # parent id -> position at the last update
+        self.nested = {}    # parent id -> its children that are parents too
+        self.active = {}    # parent id -> awake or uncaptured children, as an ordered set
+        self.woken = []     # (child, retry) woken since the last update
+        self._entities = None
+
+        events.subscribe('wake', self._wake)
+
+    def _rebuild(self, entities : List[Entity]):
+        children = {}
+        for e in entities:
+            children.setdefault(e.pair.pair_id, []).append(e)
+
+        paired = {e.id for e in entities}
+        self.children = children
+        self.roots = [p for p in children if p not in paired]
+        self.seen = {p: xy for p, xy in self.seen.items() if p in children}
+        self.nested = {p: [e for e in es if e.id in children] for p, es in children.items()}
+        self.active = {p: dict.fromkeys(es) for p, es in children.items()}
+        self._entities = entities
+
+    def _wake(self, entity : Entity):
+        self.woken.append((entity, True))
+
+    @staticmethod
+    def _capture(e : Entity, x : float, y : float):
+        e.pair.x = x - e.position.x
+        e.pair.y = y - e.position.y
+
+        # Can also remove the collision component
+        # so that arrows don't collide with each other
+        # after hitting the target
+
+        if e.has(VelocityComponent) and e.has(RotateComponent):
+            e.rotate.rotateWithVelocity = False
+            # e.dettach(VelocityComponent)
+
+    @staticmethod
+    def _place(e : Entity, x : float, y : float):
+        e.position.x = x - e.pair.x
+        e.position.y = y - e.pair.y
+
     def update(self):
         entities = self.get()
 
-        for e in entities:
-            paired = Entity.get(e.pair.pair_id)
-
-            if not hasattr(e.pair, 'x'):
-                e.pair.x = paired.position.x - e.position.x
-            if not hasattr(e.pair, 'y'):
-                e.pair.y = paired.position.y - e.position.y
-
-            # Can also remove the collision component
-            # so that arrows don't collide with each other
-            # after hitting the target
-
-            if e.has(CollisionComponent):
-                if not hasattr(e.pair, 'x1'):
-                    e.pair.x1 = paired.position.x - e.collide.x1
-                    e.pair.x2 = paired.position.x - e.collide.x2
-                if not hasattr(e.pair, 'y1'):
-                    e.pair.y1 = paired.position.y - e.collide.y1
-                    e.pair.y2 = paired.position.y - e.collide.y2
-
-            e.position.x = paired.position.x - e.pair.x
-            e.position.y = paired.position.y - e.pair.y
-
-            if e.has(CollisionComponent):
-                e.collide.x1 = paired.position.x - e.pair.x1
-                e.collide.x2 = paired.position.x - e.pair.x2
-                e.collide.y1 = paired.position.y - e.pair.y1
-                e.collide.y2 = paired.position.y - e.pair.y2
-
-            if e.has(VelocityComponent) and e.has(RotateComponent):
-                e.rotate.rotateWithVelocity = False
-                # e.dettach(VelocityComponent)
+        # The hierarchy only changes when the set of paired entities does
+        if entities is not self._entities:
+            self._rebuild(entities)
+
+        # Woken children are placed even if their parent stays put. One
+        # woken while events were being dispatched is only awake after
+        # the next sync, so it gets one more update to get there
+        woken, self.woken = self.woken, []
+        for (e, retry) in woken:
+            if not Entity.alive(e.id) or not e.has(PairedComponent):
+                continue
+            if e.has(SleepComponent):
+                if retry:
+                    self.woken.append((e, False))
+                continue
+            active = self.active.get(e.pair.pair_id)
+            if active is not None:
+                active[e] = None
+
+        children = self.children
+        stale = []
+        stack = list(self.roots)
+
+        while stack:
+            pid = stack.pop()
+            parent = Entity.get(pid)
+
+            # The entity they were paired to has been despawned
+            if parent is None:
+                stale.extend(children[pid])
+                continue
+
+            x, y = parent.position.x, parent.position.y
+            moved = self.seen.get(pid) != (x, y)
+            self.seen[pid] = (x, y)
+
+            if moved:
+                for e in children[pid]:
+                    if e.pair.x is None:
+                        self._capture(e, x, y)
+                    else:
+                        self._place(e, x, y)
+                self.active[pid] = {e: None for e in children[pid] if not e.has(SleepComponent)}
+            else:
+                # Awake children may have been moved by something else,
+                # asleep ones stay put until their parent moves
+                active = self.active[pid]
+                for e in list(active):
+                    if e.pair.x is None:
+                        self._capture(e, x, y)
+                    elif not e.has(SleepComponent):
+                        self._place(e, x, y)
+
+                    if e.has(SleepComponent):
+                        del active[e]
+
+            # Parents are placed before their children look at them
+            stack.extend(e.id for e in self.nested[pid])
+
+        for e in stale:
+            e.dettach(PairedComponent)
+            wake(e)
+
+def shift(e : Entity, dx : float = 0.0, dy : float = 0.0):
+    r"""
+        Move a body while collisions are being resolved. Its world box
+        moves with it so the rest of the pass sees where it ended up
+    """
+    if e.has(PositionComponent):
+        e.position.x += dx
+        e.position.y += dy
+
+    e.collide.x1 += dx
+    e.collide.x2 += dx
+    e.collide.y1 += dy
+    e.collide.y2 += dy
 
 def collision_x_handler(id1, id2):
     _e1 = Entity.get(id1)
@@ -186,20 +1087,16 @@ def collision_x_handler(id1, id2):
         if (e1.collide.ctype == CollisionType.SLIDE):
             if (e1.collide.x2 > e2.collide.x1) and (e1.collide.x1 < e2.collide.x1):     
                 diff = e1.collide.x2 - e2.collide.x1
-                if e1.has(PositionComponent): e1.position.x -= diff
-                e1.collide.x1 -= diff
-                e1.collide.x2 -= diff
+                shift(e1, dx = -diff)
                 # if e1.has(VelocityComponent): e1.velocity.vx = -0.3 * abs(e1.velocity.vx)
 
             if (e1.collide.x1 < e2.collide.x2) and (e1.collide.x2 > e2.collide.x2):
                 diff = e2.collide.x2 - e1.collide.x1
-                if e1.has(PositionComponent): e1.position.x += diff
-                e1.collide.x1 += diff
-                e1.collide.x2 += diff
+                shift(e1, dx = diff)
                 # if e1.has(VelocityComponent): e1.velocity.vx = 0.3 * abs(e1.velocity.vx)
 
         if (e1.collide.ctype == CollisionType.STICK) and not e1.has(PairedComponent):
-            e1.attach(PairedComponent(e2.id))
+            commands.attach(e1, PairedComponent(e2.id))
 
 def collision_y_handler(id1, id2):
     _e1 = Entity.get(id1)
@@ -215,18 +1112,14 @@ def collision_y_handler(id1, id2):
         if (e1.collide.ctype == CollisionType.SLIDE):
             if (e1.collide.y1 > e2.collide.y2) and (e1.collide.y2 < e2.collide.y2):
                 diff = e1.collide.y1 - e2.collide.y2
-                if e1.has(PositionComponent): e1.position.y -= diff
-                e1.collide.y1 -= diff
-                e1.collide.y2 -= diff
+                shift(e1, dy = -diff)
             if (e1.collide.y2 < e2.collide.y1) and (e1.collide.y1 > e2.collide.y1):
                 diff = e2.collide.y1 - e1.collide.y2
-                if e1.has(PositionComponent): e1.position.y += diff
-                e1.collide.y1 += diff
-                e1.collide.y2 += diff
+                shift(e1, dy = diff)
                 if e1.has(VelocityComponent): e1.velocity.vy = 0
 
         if (e1.collide.ctype == CollisionType.STICK) and not e1.has(PairedComponent):
-            e1.attach(PairedComponent(e2.id))
+            commands.attach(e1, PairedComponent(e2.id))
 
 class DrawSystem(System):
     r"""
@@ -237,7 +1130,12 @@ class DrawSystem(System):
 class CustomMotionSystem(System):
     r"""
         Moves an object based on a pre-determined path
-        without any physical interactions
+        without any physical interactions.
+
+        Every path is evaluated once per update. Entities that share a
+        vectorized expression are moved with a single call, and periodic
+        paths are sampled into a lookup table once and interpolated.
+        The motion settings are read when an entity joins the system
     """
     
     def __init__(self):
@@ -246,32 +1144,86 @@ class CustomMotionSystem(System):
         self.subscribe(PositionComponent)
         self.subscribe(CustomMotionComponent)
 
+        # (expression, period, samples) -> (times, values)
+        self.tables = {}
+
+        self._entities = None
+        self._groups = ([], [])
+        self._origins = None
+        self._phases = None
+        self._rows = RowCache(PositionComponent.store)
+
+    def _table(self, expression : Callable, motion : CustomMotionComponent) -> Tuple[np.ndarray, np.ndarray]:
+        key = (expression, motion.period, motion.samples)
+
+        if key not in self.tables:
+            times = np.linspace(0.0, motion.period, motion.samples)
+            if motion.vectorized:
+                values = np.broadcast_to(expression(times), times.shape).astype(float)
+            else:
+                values = np.array([expression(t) for t in times.tolist()], dtype=float)
+            self.tables[key] = (times, values)
+
+        return self.tables[key]
+
+    def _rebuild(self, entities : List[Entity]):
+        # Entities are grouped per axis by how their path is evaluated
+        groups = ({}, {})
+
+        for i, e in enumerate(entities):
+            m = e.motion
+            if m.ox is None:
+                m.ox = e.position.x
+            if m.oy is None:
+                m.oy = e.position.y
+
+            for axis, expression in enumerate((m.expression_x, m.expression_y)):
+                if expression is None:
+                    continue
+
+                if m.period is not None:
+                    kind, path = 'table', self._table(expression, m)
+                elif m.vectorized:
+                    kind, path = 'vectorized', expression
+                else:
+                    kind, path = 'scalar', expression
+
+                group = groups[axis].setdefault((kind, id(path)), (kind, path, []))
+                group[2].append(i)
+
+        self._groups = tuple(
+            [(kind, path, np.array(idx, dtype=np.intp)) for kind, path, idx in g.values()]
+            for g in groups
+        )
+        self._origins = np.array([(e.motion.ox, e.motion.oy) for e in entities], dtype=float)
+        self._phases = np.array([e.motion.phase for e in entities], dtype=float)
+        self._entities = entities
+
     def update(self, t : float = 0):
         entities = self.get()
+        if not entities:
+            return
 
-        for e in entities:
+        # Groups only change when the set of moving entities does
+        if entities is not self._entities:
+            self._rebuild(entities)
+
+        rows = self._rows.get(entities)
+        positions = PositionComponent.store.array
+
+        for axis, groups in enumerate(self._groups):
+            for kind, path, idx in groups:
+                times = t + self._phases[idx]
+
+                if kind == 'table':
+                    samples, values = path
+                    offset = np.interp(times % samples[-1], samples, values)
+                elif kind == 'vectorized':
+                    offset = path(times)
+                else:
+                    offset = [path(time) for time in times.tolist()]
 
-            if not hasattr(e.motion, 'ox'):
-                e.motion.ox = e.position.x
-                if e.has(CollisionComponent):
-                    e.motion.ox1 = e.collide.x1
-                    e.motion.ox2 = e.collide.x2
-            if not hasattr(e.motion, 'oy'):
-                e.motion.oy = e.position.y
-                if e.has(CollisionComponent):
-                    e.motion.oy1 = e.collide.y1
-                    e.motion.oy2 = e.collide.y2
-
-            if e.motion.expression_x is not None:
-                e.position.x = e.motion.expression_x(t) + e.motion.ox
-                if e.has(CollisionComponent):
-                    e.collide.x1 = e.motion.expression_x(t) + e.motion.ox1
-                    e.collide.x2 = e.motion.expression_x(t) + e.motion.ox2
-            if e.motion.expression_y is not None:
-                e.position.y = e.motion.expression_y(t) + e.motion.oy
-                if e.has(CollisionComponent):
-                    e.collide.y1 = e.motion.expression_y(t) + e.motion.oy1
-                    e.collide.y2 = e.motion.expression_y(t) + e.motion.oy2
+                positions[rows[idx], axis] = self._origins[idx, axis] + offset
 
 class ShooterSystem(System):
     def __init__(self):
@@ -294,7 +1246,7 @@ class ShooterSystem(System):
             ry = e.shooter.r * sin(e.shooter.angle) + e.shooter.y
 
             if not e.has(PositionComponent):
-                e.attach(PositionComponent(rx, ry))
+                commands.attach(e, PositionComponent(rx, ry))
             else:
                 e.position.x = rx
                 e.position.y = ry
@@ -312,13 +1264,13 @@ class ScoreSystem(System):
         for e in entities:
             p = Entity.get(e.pair.pair_id)
             
-            if p.has(NameComponent):
+            if p is not None and p.has(NameComponent):
                 if p.name.name == "target":
                     score += 1
 
-        font = pygame.font.Font(pygame.font.get_default_font(), 30)
-        text = font.render("Score: {}".format(score), True, 'black')
-        screen.blit(text, (0, 0))
+        # Only rendered again when the score changes
+        text = texts.render("Score: {}".format(score), 30, 'black')
+        return screen.blit(text, (0, 0))
 
 def cartesian_to_screen(cart_x, cart_y, width, height):
     screen_x = cart_x
@@ -1,7 +1,7 @@
 import pygame
 
 from archery_game.engine.ecs import Entity, System
-from archery_game.engine.components import PositionComponent, ControlComponent, CollisionComponent
+from archery_game.engine.components import PositionComponent, ControlComponent
 
 class MovementSystem(System):
     def __init__(self, entity_id, speed = 1, dir='xy'):
@@ -18,6 +18,8 @@ class MovementSystem(System):
 
     def update(self, mode : str):
         e = Entity.get(self.entity_id)
+        if e is None:
+            return
 
         keys = pygame.key.get_pressed()
         speed = self.speed
@@ -25,23 +27,11 @@ class MovementSystem(System):
         if mode == 'x' and 'x' in self.dir:
             if keys[pygame.K_LEFT] or keys[pygame.K_a]:
                 e.position.x -= speed
-                if e.has(CollisionComponent):
-                    e.collide.x1 -= speed
-                    e.collide.x2 -= speed
             if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
                 e.position.x += speed
-                if e.has(CollisionComponent):
-                    e.collide.x1 += speed
-                    e.collide.x2 += speed
         
         elif mode == 'y' and 'y' in self.dir:
             if keys[pygame.K_UP] or keys[pygame.K_w]:
                 e.position.y += speed
-                if e.has(CollisionComponent):
-                    e.collide.y1 += speed
-                    e.collide.y2 += speed
             if keys[pygame.K_DOWN] or keys[pygame.K_s]:
-                e.position.y -= speed
-                if e.has(CollisionComponent):
-                    e.collide.y1 -= speed
-                    e.collide.y2 -= speed
\ No newline at end of file
+                e.position.y -= speed
\ No newline at end of file
@@ -2,6 +2,7 @@ import time
 from math import cos, sin
 
 import pygame
+from archery_game.engine.assets import texts
 from archery_game.engine.components import (NameComponent, PositionComponent,
                                             RenderComponent, VelocityComponent)
 from archery_game.engine.ecs import Entity
@@ -83,8 +84,7 @@ def main():
                         )
                     ])
 
-        font = pygame.font.Font(pygame.font.get_default_font(), 20)
-        text = font.render("Press SPACE to shoot!", True, 'black')
+        text = texts.render("Press SPACE to shoot!", 20, 'black')
         screen.blit(text, (0, 0))
 
         t += dt
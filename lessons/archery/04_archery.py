@@ -3,18 +3,20 @@ from math import atan2, cos, sin
 
 import pygame
 import argparse
-from archery_game.engine.components import (CollisionComponent, CollisionType,
+from archery_game.engine.assets import texts
+from archery_game.engine.components import (CollisionComponent, CollisionLayer,
+                                            CollisionType,
                                             CustomMotionComponent,
                                             NameComponent, PositionComponent,
                                             RenderComponent, RotateComponent,
                                             ShooterComponent,
                                             VelocityComponent)
-from archery_game.engine.ecs import Entity
+from archery_game.engine.ecs import Entity, commands
 from archery_game.engine.render import WHITE, RenderSystem, gradientRect
 from archery_game.engine.systems import (CollisionSystem, CustomMotionSystem,
                                          PairedSystem, PhysicsSystem,
                                          RotateSystem, ScoreSystem,
-                                         ShooterSystem)
+                                         ShooterSystem, SleepSystem)
 
 
 def main():
@@ -37,7 +39,8 @@ def main():
         PositionComponent(),
         CollisionComponent(
             x1=0, x2=width, y1=20, y2=0,
-            ctype=CollisionType.RIGID
+            ctype=CollisionType.RIGID,
+            layer=CollisionLayer.SCENERY
         ),
         RenderComponent(
             path = 'lessons//archery//grass.png',
@@ -52,6 +55,12 @@ def main():
     color_box = gradientRect(sky_box, (230, 242, 255), (0, 153, 255))
     color_box = pygame.transform.rotate(color_box, 90)
 
+    # The renderer bakes the sky and everything that never moves into
+    # one layer, so none of it is redrawn every frame
+    background = pygame.Surface(size).convert()
+    background.fill(WHITE)
+    background.blit(color_box, sky_box)
+
     target = Entity([
         NameComponent("target"),
         PositionComponent(245, 270),
@@ -63,7 +72,8 @@ def main():
         ),
         CollisionComponent(
             x1=245, x2=255, y1=270, y2=220,
-            ctype=CollisionType.RIGID
+            ctype=CollisionType.RIGID,
+            layer=CollisionLayer.TARGET
         ),
         CustomMotionComponent(
             # expression_x = lambda t : 80*cos(t/1.5),
@@ -116,13 +126,14 @@ def main():
 
 
     physics  = PhysicsSystem()
-    renderer = RenderSystem()
+    renderer = RenderSystem(background = background)
     collider = CollisionSystem()
     pairer   = PairedSystem()
     shooter  = ShooterSystem()
     move     = CustomMotionSystem()
     scorer   = ScoreSystem()
     rotater  = RotateSystem()
+    sleeper  = SleepSystem()
 
     t     = 0            # the initial time
     dt    = 5 / 60       # the simulator time step
@@ -133,22 +144,21 @@ def main():
     running = True
     while running:
         clock.tick(frame)
-        screen.fill(WHITE)
-        screen.blit(color_box, sky_box)
 
         shooter.update()
 
         move.update(t)
 
         physics.update('y', dt = dt)
-        collider.update('y')
+        collider.update('y', dt = dt)
         physics.update('x', dt = dt)
-        collider.update('x')
+        collider.update('x', dt = dt)
 
         pairer.update()
+        sleeper.update()
         rotater.update()
         renderer.update(screen, width, height)
-        scorer.update(screen)
+        renderer.mark_dirty(scorer.update(screen))
 
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -161,7 +171,8 @@ def main():
                     col_x = x*cos(bow.shooter.angle) - y*sin(bow.shooter.angle)
                     col_y = x*sin(bow.shooter.angle) + y*cos(bow.shooter.angle)
 
-                    Entity([
+                    # Spawned at the next sync point, once event handling is done
+                    commands.spawn([
                         NameComponent("arrow"),
                         PositionComponent(bow.shooter.x+col_x, bow.shooter.y+col_y),
                         VelocityComponent(speed*cos(bow.shooter.angle), speed*sin(bow.shooter.angle)),
@@ -176,19 +187,22 @@ def main():
                         CollisionComponent(
                             x1=bow.shooter.x+col_x, x2=bow.shooter.x+1+col_x,
                             y1=bow.shooter.y+col_y, y2=bow.shooter.y-1+col_y,
-                            ctype=CollisionType.STICK
+                            ctype=CollisionType.STICK,
+                            # Arrows never collide with each other
+                            layer=CollisionLayer.PROJECTILE,
+                            mask=~CollisionLayer.PROJECTILE,
+                            # Fast enough to skip through the target in one step
+                            continuous=True
                         ),
                     ])
 
-        font = pygame.font.Font(pygame.font.get_default_font(), 10)
-        text = font.render("Press SPACE to shoot!", True, 'black')
-        screen.blit(text, (0, 30))
-        font = pygame.font.Font(pygame.font.get_default_font(), 10)
-        text = font.render("Press LEFT and RIGHT to aim", True, 'black')
-        screen.blit(text, (0, 45))
+        text = texts.render("Press SPACE to shoot!", 10, 'black')
+        renderer.mark_dirty(screen.blit(text, (0, 30)))
+        text = texts.render("Press LEFT and RIGHT to aim", 10, 'black')
+        renderer.mark_dirty(screen.blit(text, (0, 45)))
 
         t += dt
-        pygame.display.update()
+        renderer.present()
           
 if __name__=="__main__":
     main()
@@ -4,12 +4,15 @@ import uuid
 from math import cos, sin
 
 import pygame
+from archery_game.engine.assets import texts
 from archery_game.engine.components import (AccelerationComponent,
-                                            CollisionComponent, CollisionType,
+                                            CollisionComponent, CollisionLayer,
+                                            CollisionType,
                                             ControlComponent, NameComponent,
                                             PositionComponent, RenderComponent,
                                             RotateComponent, VelocityComponent)
-from archery_game.engine.ecs import Entity, Observer, System
+from archery_game.engine.ecs import (ComponentPool, Entity, Observer, System,
+                                     commands)
 from archery_game.engine.render import WHITE, RenderSystem
 from archery_game.engine.systems import CollisionSystem, PhysicsSystem
 from archery_game.engine.userinput import MovementSystem
@@ -23,21 +26,27 @@ def asteroid_factory(x, y, vel, size=[20, 20]):
 
     angle = random.randint(0, 360) * 3.14159 / 180
 
+    # Components of despawned asteroids are reused from the pool
+    acquire = ComponentPool.acquire
+
     return Entity([
-        NameComponent( 'asteroid' ),
-        PositionComponent(x, y),
-        VelocityComponent(-vel, 0),
-        AccelerationComponent(ay=0.0),
-        RenderComponent(
+        acquire(NameComponent, 'asteroid'),
+        acquire(PositionComponent, x, y),
+        acquire(VelocityComponent, -vel, 0),
+        acquire(AccelerationComponent, ay=0.0),
+        acquire(RenderComponent,
             path = 'lessons/asteroids/asteroid.png',
             size = (2*s[0], 2*s[1]),
             center = (0, 0),
             debug = False,
         ),
-        RotateComponent(ut = angle, rotateWithVelocity=False),
-        CollisionComponent(
+        acquire(RotateComponent, ut = angle, rotateWithVelocity=False),
+        acquire(CollisionComponent,
             ctype=CollisionType.RIGID,
-            x1=x-s[0], x2=x+s[0], y1=y+s[0], y2=y-s[0]
+            x1=x-s[0], x2=x+s[0], y1=y+s[0], y2=y-s[0],
+            # Asteroids only need to be tested against the rocket
+            layer=CollisionLayer.ENEMY,
+            mask=CollisionLayer.PLAYER
         ),
     ])
 
@@ -65,13 +74,15 @@ class GameState(Observer):
             if 'rocket' in names and 'asteroid' in names:
                 self.lose = True
 
-        self.watch('collision', _collision_callback)
+        # Only the first touch matters, not every frame the two overlap
+        self.watch('collision_enter', _collision_callback)
 
 class AsteroidScoreSystem(System):
     def __init__(self):
         super().__init__()
 
         self.score = 0
+        self.passed = 0
 
         self.subscribe(PositionComponent)
         self.subscribe(NameComponent)
@@ -79,19 +90,18 @@ class AsteroidScoreSystem(System):
     def update(self, screen, **kwargs):
         entities = self.get()
     
-        self.score = 0
+        self.score = self.passed
         for e in entities:            
             if e.position.x < 0 and 'asteroid' in e.name.name:
                 self.score += 1
                 
-            # Remove attributes for performance reasons
+            # Asteroids far off screen are gone for good, so despawn
+            # them and keep count of how many made it past the rocket
             if e.position.x < -30 and 'asteroid' in e.name.name:
-                e.dettach(RenderComponent)
-                e.dettach(CollisionComponent)
-                e.dettach(VelocityComponent)
+                self.passed += 1
+                commands.despawn(e)
 
-        font = pygame.font.Font(pygame.font.get_default_font(), 30)
-        text = font.render("Score: {}".format(self.score), True, 'white')
+        text = texts.render("Score: {}".format(self.score), 30, 'white')
         screen.blit(text, (0, 0))
 
 def main():
@@ -113,14 +123,15 @@ def main():
             path='lessons/asteroids/rocket.png',
             center=(20, 10)
         ),
-        CollisionComponent(x1=30, x2=70, y1=60, y2=40)
+        CollisionComponent(x1=30, x2=70, y1=60, y2=40, layer=CollisionLayer.PLAYER)
     ])
 
     # Add some walls to the scene so the rocket can't cheat out
-    Entity([ CollisionComponent(ctype=CollisionType.RIGID, x1=0, x2=width, y1=0, y2=-10) ])
-    Entity([ CollisionComponent(ctype=CollisionType.RIGID, x1=0, x2=width, y1=height+10, y2=height) ])
-    Entity([ CollisionComponent(ctype=CollisionType.RIGID, x1=-10, x2=0, y1=height, y2=0) ])
-    Entity([ CollisionComponent(ctype=CollisionType.RIGID, x1=width, x2=width+10, y1=height, y2=0) ])
+    walls = dict(ctype=CollisionType.RIGID, layer=CollisionLayer.SCENERY, mask=CollisionLayer.PLAYER)
+    Entity([ CollisionComponent(x1=0, x2=width, y1=0, y2=-10, **walls) ])
+    Entity([ CollisionComponent(x1=0, x2=width, y1=height+10, y2=height, **walls) ])
+    Entity([ CollisionComponent(x1=-10, x2=0, y1=height, y2=0, **walls) ])
+    Entity([ CollisionComponent(x1=width, x2=width+10, y1=height, y2=0, **walls) ])
 
     # Add the skybox
     Entity([
@@ -174,8 +185,7 @@ def main():
         renderer.update(screen, width, height)
         scorer.update(screen=screen)
         if game.lose:
-            font = pygame.font.Font(pygame.font.get_default_font(), 50)
-            text = font.render("GAME OVER!", True, 'red')
+            text = texts.render("GAME OVER!", 50, 'red')
             screen.blit(text, (width/6, height/2))
 
         for event in pygame.event.get():
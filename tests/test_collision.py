@@ -0,0 +1,76 @@
+import pytest
+
+from archery_game.engine.components import (CollisionComponent, CollisionType,
+                                            PositionComponent, SleepComponent,
+                                            VelocityComponent)
+from archery_game.engine.ecs import Entity, events, sync
+from archery_game.engine.systems import CollisionSystem, wake
+
+
+@pytest.fixture(autouse=True)
+def empty_world():
+    yield
+    for e in list(Entity.entity_index.values()):
+        e.despawn()
+    sync()
+
+
+def body(x, y):
+    # Rigid bodies with a velocity are dynamic but never pushed apart
+    return Entity([
+        PositionComponent(x=x, y=y),
+        VelocityComponent(),
+        CollisionComponent(x1=x - 5, x2=x + 5, y1=y + 5, y2=y - 5, ctype=CollisionType.RIGID)
+    ])
+
+
+def test_parked_contacts_leave_with_despawned_bodies():
+    entered = []
+    def on_enter(**kwargs):
+        entered.append(kwargs)
+    events.subscribe('collision_enter', on_enter)
+
+    cs = CollisionSystem()
+    floor = Entity([
+        PositionComponent(x=50, y=0),
+        CollisionComponent(x1=0, x2=100, y1=1, y2=-1, ctype=CollisionType.RIGID)
+    ])
+    sleepers = [body(10 + 20 * i, 5) for i in range(5)]
+
+    cs.update('y')
+    assert len(cs.contacts) == 5
+
+    for e in sleepers:
+        e.attach(SleepComponent())
+    cs.update('y')
+    assert len(cs.contacts) == 0
+    assert len(cs.parked) == 5
+
+    for e in sleepers:
+        e.despawn()
+    cs.update('y')
+    assert cs.parked == {}
+    assert floor.has(CollisionComponent)
+
+
+def test_parked_contacts_come_back_on_wake():
+    def on_enter(**kwargs):
+        pass
+    events.subscribe('collision_enter', on_enter)
+
+    cs = CollisionSystem()
+    a = body(0, 0)
+    b = body(4, 0)
+
+    cs.update('x')
+    assert len(cs.contacts) == 1
+
+    b.attach(SleepComponent())
+    a.attach(SleepComponent())
+    cs.update('x')
+    assert len(cs.contacts) == 0
+    assert set(cs.parked) == {a.id, b.id}
+
+    wake(a)
+    assert len(cs.contacts) == 1
+    assert cs.parked == {}
@@ -0,0 +1,74 @@
+import pytest
+
+from archery_game.engine import render
+from archery_game.engine.components import (PositionComponent, RenderComponent,
+                                            VelocityComponent)
+from archery_game.engine.ecs import Entity, Query, sync
+from archery_game.engine.render import Camera, RenderList, RenderSystem
+
+
+@pytest.fixture(autouse=True)
+def empty_world():
+    yield
+    for e in list(Entity.entity_index.values()):
+        e.despawn()
+    sync()
+
+
+def sprite(priority):
+    return Entity([RenderComponent(priority=priority)])
+
+
+def test_render_list_follows_its_query():
+    a = sprite(1)
+    order = RenderList(Query.of([RenderComponent]))
+    b = sprite(0)
+    c = sprite(1)
+    assert order.entities == [b, a, c]
+
+    first = order.entities
+    assert order.entities is first
+
+    b.despawn()
+    d = sprite(-1)
+    assert order.entities == [d, a, c]
+    assert order.entities is not first
+    assert len(order) == 3
+
+
+def test_render_list_moves_entities_that_change_priority():
+    order = RenderList(Query.of([RenderComponent]))
+    a = sprite(0)
+    b = sprite(1)
+
+    a.render.priority = 2
+    assert order.entities == [b, a]
+
+    # A replaced component is followed too, and the old one is forgotten
+    old = b.render
+    b.attach(RenderComponent(priority=3))
+    old.priority = -1
+    assert order.entities == [a, b]
+
+    b.render.priority = -1
+    assert order.entities == [b, a]
+
+
+def test_visible_keeps_sprites_in_view(monkeypatch):
+    monkeypatch.setattr(render, 'CULL_GRID', 8)
+
+    system = RenderSystem(camera=Camera(100, 100))
+    inside = Entity([RenderComponent(), PositionComponent(x=50, y=50)])
+    moving = Entity([RenderComponent(), PositionComponent(x=20, y=20), VelocityComponent()])
+    loose = Entity([RenderComponent()])
+    # Enough still sprites for them to be looked up in a grid
+    row = [Entity([RenderComponent(), PositionComponent(x=200 * i + 500, y=50)]) for i in range(10)]
+    sync()
+
+    order = system.order.entities
+    assert system.visible(order) == [inside, moving, loose]
+
+    # Still sprites are allowed to be moved by hand
+    row[5].position.x = 60
+    moving.position.x = -500
+    assert system.visible(order) == [inside, loose, row[5]]
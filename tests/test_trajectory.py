@@ -0,0 +1,62 @@
+import pytest
+
+from archery_game.engine.components import PositionComponent
+from archery_game.engine.ecs import Entity, sync
+from archery_game.engine.systems import TrackTrajectorySystem
+
+
+@pytest.fixture(autouse=True)
+def empty_world():
+    yield
+    for e in list(Entity.entity_index.values()):
+        e.despawn()
+    sync()
+
+
+def test_spill_keeps_frames_from_before_a_gap(tmp_path):
+    tracker = TrackTrajectorySystem(capacity=16, spill=str(tmp_path))
+    e = Entity([PositionComponent()])
+
+    for frame in range(10):
+        if frame == 4:
+            e.dettach(PositionComponent)
+        if frame == 6:
+            e.attach(PositionComponent())
+        if e.has(PositionComponent):
+            e.position.x = frame
+        tracker.update()
+
+    tracker.flush()
+    xs = TrackTrajectorySystem.load(str(tmp_path))[e.id][:, 0]
+    assert xs.tolist() == [0, 1, 2, 3, 6, 7, 8, 9]
+
+
+def test_spill_saves_every_frame_across_wraps(tmp_path):
+    tracker = TrackTrajectorySystem(capacity=4, spill=str(tmp_path))
+    a = Entity([PositionComponent()])
+    b = Entity([PositionComponent()])
+
+    for frame in range(11):
+        if frame == 7:
+            b.despawn()
+        for e in (a, b) if frame < 7 else (a,):
+            e.position.x = frame
+        tracker.update()
+
+    tracker.flush()
+    trajectories = TrackTrajectorySystem.load(str(tmp_path))
+    assert trajectories[a.id][:, 0].tolist() == list(range(11))
+    assert trajectories[b.id][:, 0].tolist() == list(range(7))
+
+
+def test_untracked_slots_are_freed_without_spill():
+    tracker = TrackTrajectorySystem(capacity=4)
+    a = Entity([PositionComponent()])
+    b = Entity([PositionComponent()])
+    tracker.update()
+
+    b.despawn()
+    tracker.update()
+
+    assert set(tracker.slots) == {a.id}
+    assert tracker.trajectory(b.id).shape == (0, 2)